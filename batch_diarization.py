@@ -0,0 +1,207 @@
+import os
+import sys
+import glob
+import hashlib
+import copy
+import shutil
+import argparse
+import numpy as np
+from concurrent.futures import wait, FIRST_COMPLETED
+from tools import wavTranscriber, wavSplit, featureCache, featureFrontend, runtimeConfig
+import diarization
+import demo_diarization
+from timeit import default_timer as timer
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.flac', '.ogg', '.m4a')
+EMBEDDING_PER_SEC = 1
+OVERLAP_RATE = 0.4
+WIN_LEN = 400
+HOP_LEN = 160
+
+def collect_audio_files(inputs):
+    """Expand directories, glob patterns and manifest files into audio paths.
+
+    A manifest is any existing file without an audio extension; it lists
+    one audio path per line.
+    """
+    audio_files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in sorted(os.walk(item)):
+                audio_files += [os.path.join(root, f) for f in sorted(files) if f.lower().endswith(AUDIO_EXTENSIONS)]
+        elif os.path.isfile(item) and not item.lower().endswith(AUDIO_EXTENSIONS):
+            with open(item) as f:
+                audio_files += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        else:
+            audio_files += sorted(glob.glob(item, recursive=True))
+    # drop duplicates, keep order
+    return list(dict.fromkeys(audio_files))
+
+def output_name(audio_file):
+    """Output name of `audio_file`: its name plus a hash of its absolute path.
+
+    Inputs are collected recursively, so files of the same name in different
+    directories must not share an output (nor be skipped as already done).
+    """
+    path_hash = hashlib.sha1(os.path.abspath(audio_file).encode('utf-8')).hexdigest()[:8]
+    return '{}-{}'.format(os.path.splitext(os.path.basename(audio_file))[0], path_hash)
+
+def prepare_file(audio_file, pad_silence_ms, audio_cache_dir, feature_cache_dir='', spool_dir=''):
+    """Decode, VAD and STFT one file. Runs in a pool worker.
+
+    The spectrogram stays on disk: with `feature_cache_dir` it is the
+    cached one, which is also reused from an earlier run along with VAD,
+    otherwise it is written to `spool_dir`. Only its path goes back to the
+    parent, which memory-maps it when the d-vectors are not cached.
+    """
+    feature_cache = None
+    if feature_cache_dir:
+        feature_cache = featureCache.FeatureCache(feature_cache_dir, audio_file)
+    wav_file = wavSplit.format_wave(audio_file, audio_cache_dir)
+    frontend = featureFrontend.FeatureFrontend.from_file(wav_file, aggressiveness=3, frame_duration_ms=30,
+                                                        feature_cache=feature_cache)
+    segments, sample_rate, _ = wavTranscriber.vad_segment_generator(wav_file,
+                                                                    aggressiveness=3,
+                                                                    frame_duration_ms=30,
+                                                                    padding_duration_ms=pad_silence_ms,
+                                                                    cache_dir=audio_cache_dir,
+                                                                    feature_cache=feature_cache,
+                                                                    frontend=frontend)
+    mag = diarization.cached_magnitude(segments, win_len=WIN_LEN, hop_len=HOP_LEN, feature_cache=feature_cache)
+    if feature_cache is not None:
+        mag_path = feature_cache.path('magnitude', win_len=WIN_LEN, hop_len=HOP_LEN)
+    else:
+        mag_path = os.path.join(spool_dir, output_name(audio_file) + '.npy')
+        with open(mag_path + '.part', 'wb') as f:
+            np.save(f, mag)
+        os.replace(mag_path + '.part', mag_path)
+    for segment in segments:
+        segment.audio = None  # re-mapped in the parent instead of pickled
+    # the frame decisions go back with the segments for the silence check
+    return audio_file, wav_file, segments, sample_rate, mag_path, frontend.speech_flags, feature_cache
+
+def remove_output(path):
+    """Remove a transcript file or audio segment directory, if it exists."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def finish_file(args, diarizer, result):
+    """Embed, cluster and write one prepared file. Runs in the model process."""
+    audio_file, wav_file, segments, sample_rate, mag_path, speech_flags, feature_cache = result
+    try:
+        audio, _, _ = wavSplit.map_wave(wav_file)
+        frontend = featureFrontend.FeatureFrontend(audio, sample_rate, aggressiveness=3, frame_duration_ms=30,
+                                                   speech_flags=speech_flags)
+        for segment in segments:
+            segment.audio = audio
+
+        def make_windows():
+            mag = np.load(mag_path, mmap_mode='r')
+            return diarization.get_utterances_spec(mag, sample_rate, HOP_LEN, EMBEDDING_PER_SEC, OVERLAP_RATE)
+        feats = diarizer.embed_cached(make_windows, feature_cache, sr=sample_rate, win_len=WIN_LEN, hop_len=HOP_LEN,
+                                      embedding_per_sec=EMBEDDING_PER_SEC, overlap_rate=OVERLAP_RATE)
+    finally:
+        if feature_cache is None:
+            os.remove(mag_path)
+    _, labels = diarizer.label_segments(segments, feats, args.num_speakers, EMBEDDING_PER_SEC, OVERLAP_RATE,
+                                        return_labels=True)
+    windows = None
+    if args.window_labels:
+        windows = demo_diarization.window_labels(segments, labels, EMBEDDING_PER_SEC, OVERLAP_RATE)
+    joined_segments = wavTranscriber.arrange_segments(segments)
+
+    # write into a staging directory and move the result into place, so an
+    # interrupted run never leaves an output that the next run would skip
+    staging_args = copy.copy(args)
+    staging_args.output_path = os.path.join(args.output_path, '.partial')
+    os.makedirs(staging_args.output_path, exist_ok=True)
+    name = output_name(audio_file)
+    staging_target = demo_diarization.output_target(staging_args, audio_file, name)
+    try:
+        demo_diarization.write_results(staging_args, audio_file, joined_segments, sample_rate, frontend, segments,
+                                       windows, output_name=name)
+    except Exception:
+        remove_output(staging_target)
+        raise
+    target = demo_diarization.output_target(args, audio_file, name)
+    remove_output(target)
+    os.replace(staging_target, target)
+    return target
+
+def main(args):
+    start = timer()
+    # before the pool starts, so workers inherit the affinity and thread limits
+    runtimeConfig.configure_from_args(args)
+    audio_files = collect_audio_files(args.inputs)
+    todo = [audio_file for audio_file in audio_files
+            if args.overwrite or not os.path.exists(demo_diarization.output_target(args, audio_file,
+                                                                                   output_name(audio_file)))]
+    print('[INFO] {} file(s) found, {} already done, {} to process.'.format(len(audio_files),
+                                                                        len(audio_files) - len(todo),
+                                                                        len(todo)))
+    os.makedirs(args.output_path, exist_ok=True)
+    # spectrograms of prepared files waiting for the model process
+    spool_dir = os.path.join(args.output_path, '.spectrograms')
+    if not args.feature_cache_dir:
+        os.makedirs(spool_dir, exist_ok=True)
+
+    failed = []
+    with runtimeConfig.spawn_pool(args.workers) as pool:
+        diarizer = diarization.Diarizer(batch_size=args.batch_size, uisrnn_device=args.device,
+                                        ghostvlad_tflite_path=args.ghostvlad_tflite)
+        queue = iter(todo)
+        # future -> input file, so a failure can be reported by path
+        pending = {}
+        # files being prepared plus prepared files waiting for the model, so
+        # every worker stays busy while up to max_pending results wait
+        max_in_flight = (args.workers or os.cpu_count()) + args.max_pending
+
+        def fill():
+            for audio_file in queue:
+                future = pool.submit(prepare_file, audio_file, args.pad_silence_ms, args.audio_cache_dir,
+                                     args.feature_cache_dir, spool_dir)
+                pending[future] = audio_file
+                if len(pending) >= max_in_flight:
+                    break
+
+        fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                audio_file = pending.pop(future)
+                try:
+                    target = finish_file(args, diarizer, future.result())
+                    print('[INFO] Wrote {}'.format(target))
+                except Exception as e:
+                    failed.append(audio_file)
+                    print('[ERROR] {}: {!r}'.format(audio_file, e))
+            fill()
+    shutil.rmtree(spool_dir, ignore_errors=True)
+
+    print("\nFinished {} file(s), {} failed, in {:.2f} minute(s)".format(len(todo) - len(failed), len(failed),
+                                                                       (timer() - start)/60))
+    if failed:
+        print('[ERROR] Failed file(s):')
+        for audio_file in failed:
+            print('  {}'.format(audio_file))
+        # let scheduled jobs detect a partial failure
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Diarize many audio files with one set of loaded models.')
+    parser.add_argument('inputs', nargs='+',
+                        help='audio directories, glob patterns, or manifest files listing one audio path per line')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='processes for decoding, VAD and STFT')
+    parser.add_argument('--max_pending', type=int, default=8,
+                        help='maximum number of prepared files waiting for the model process, '
+                             'on top of the --workers files being prepared')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='process files whose output already exists instead of skipping them')
+    demo_diarization.add_arguments(parser)
+    runtimeConfig.add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
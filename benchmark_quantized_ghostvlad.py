@@ -0,0 +1,93 @@
+import os
+import glob
+import argparse
+import numpy as np
+import uisrnn
+import diarization
+from tools import wavSplit, wavTranscriber, runtimeConfig
+from timeit import default_timer as timer
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+EMBEDDING_PER_SEC = 1
+OVERLAP_RATE = 0.4
+
+def prepare_windows(audio_file, pad_silence_ms, audio_cache_dir):
+    """VAD and frame one file into GhostVLAD input windows, as demo_diarization does."""
+    wav_file = wavSplit.format_wave(audio_file, audio_cache_dir)
+    segments, sample_rate, _ = wavTranscriber.vad_segment_generator(wav_file,
+                                                                    aggressiveness=3,
+                                                                    frame_duration_ms=30,
+                                                                    padding_duration_ms=pad_silence_ms,
+                                                                    cache_dir=audio_cache_dir)
+    return diarization.prepare_ghostvlad_data(segments, sample_rate, 400, 160, EMBEDDING_PER_SEC, OVERLAP_RATE)
+
+def cosine(a, b):
+    return np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1) + 1e-12)
+
+def main(args):
+    runtimeConfig.configure_from_args(args)
+    diarizer = diarization.Diarizer(batch_size=args.batch_size, uisrnn_device=args.device)
+    models = [('float32', diarizer.ghostvlad_model)]
+    models += [(os.path.basename(path), diarization.TFLiteGhostVLAD(path)) for path in args.tflite]
+    totals = {name: {'windows': 0, 'seconds': 0.0, 'cosine': [], 'agreement': []} for name, _ in models}
+
+    audio_files = [path for pattern in args.audio_files for path in sorted(glob.glob(pattern))]
+    print('{:<40}{:<28}{:>10}{:>12}{:>12}{:>14}'.format('file', 'model', 'win/s', 'mean cos', 'min cos',
+                                                     'vs float32'))
+    for audio_file in audio_files:
+        windows = prepare_windows(audio_file, args.pad_silence_ms, args.audio_cache_dir)
+        if len(windows) == 0:
+            continue
+        reference_feats = reference_labels = None
+        for name, model in models:
+            start = timer()
+            feats = diarization.extract_embeddings(model, windows, batch_size=args.batch_size)
+            seconds = timer() - start
+            labels = list(diarizer.cluster(feats, args.num_speakers))
+            if reference_feats is None:
+                reference_feats, reference_labels = feats, labels
+            similarity = cosine(feats, reference_feats)
+            # no timed ground truth is bundled, so accuracy is the agreement
+            # of the window labels with the float32 model's
+            agreement = uisrnn.compute_sequence_match_accuracy(labels, reference_labels)
+            total = totals[name]
+            total['windows'] += len(windows)
+            total['seconds'] += seconds
+            total['cosine'].append(similarity)
+            total['agreement'].append(agreement)
+            print('{:<40}{:<28}{:>10.1f}{:>12.5f}{:>12.5f}{:>14.4f}'.format(os.path.basename(audio_file)[:38], name,
+                                                                          len(windows) / seconds, similarity.mean(),
+                                                                          similarity.min(), agreement))
+
+    print('\n{:<28}{:>10}{:>10}{:>12}{:>12}{:>14}'.format('model', 'win/s', 'speed-up', 'mean cos', 'min cos',
+                                                        'vs float32'))
+    reference_speed = None
+    for name, _ in models:
+        total = totals[name]
+        if not total['windows']:
+            continue
+        speed = total['windows'] / total['seconds']
+        reference_speed = reference_speed or speed
+        similarity = np.concatenate(total['cosine'])
+        print('{:<28}{:>10.1f}{:>10.2f}{:>12.5f}{:>12.5f}{:>14.4f}'.format(name, speed, speed / reference_speed,
+                                                                         similarity.mean(), similarity.min(),
+                                                                         np.mean(total['agreement'])))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare quantized GhostVLAD models with the float32 model: '
+                                                 'throughput, embedding cosine drift and clustering agreement.')
+    parser.add_argument('tflite', nargs='*',
+                        help='.tflite models from ghostvlad/quantize_inference.py')
+    parser.add_argument('--audio_files', nargs='+', default=['test-data/*.wav'],
+                        help='audio files or glob patterns to evaluate on')
+    parser.add_argument('--num_speakers', type=int, default=10,
+                        help='manual speaker limit')
+    parser.add_argument('--pad_silence_ms', type=int, default=300,
+                        help='pad silence duration in millisecond for each segment during voice activity detection')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='number of utterance windows per ghostvlad predict call')
+    parser.add_argument('--audio_cache_dir', type=str, default=wavSplit.NORMALIZED_AUDIO_DIR,
+                        help='directory of decoded 16 kHz mono copies of non-wav or non-canonical inputs')
+    runtimeConfig.add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,106 @@
+import os
+import sys
+import copy
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+import numpy as np
+import uisrnn
+from timeit import default_timer as timer
+
+UISRNN_PATH = "uisrnn/pretrained/saved_model.uisrnn_benchmark"
+
+def synthetic_sequence(length, num_speakers, dim=512, turn_len=8, seed=0):
+    """Random d-vector sequence with speaker turns, and its true labels."""
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(num_speakers, dim))
+    labels = []
+    while len(labels) < length:
+        labels += [rng.randint(num_speakers)] * rng.randint(1, 2 * turn_len)
+    labels = labels[:length]
+    feats = centers[labels] + 0.5 * rng.normal(size=(length, dim))
+    feats /= np.linalg.norm(feats, axis=1, keepdims=True)
+    return feats.astype(float), labels
+
+def load_reference(reference):
+    """Load a reference `uisrnn/uisrnn.py` as its own module.
+
+    `reference` is a path to the file, or a git revision to take it from;
+    empty means the root commit, the original loop-based beam search. Its
+    `from uisrnn import ...` lines resolve to the current package, whose
+    loss and utility functions the beam search changes did not touch.
+    """
+    if os.path.isfile(reference):
+        path = reference
+    else:
+        repo = os.path.dirname(os.path.abspath(__file__))
+        if not reference:
+            reference = subprocess.check_output(['git', 'rev-list', '--max-parents=0', 'HEAD'],
+                                                cwd=repo, universal_newlines=True).split()[0]
+        source = subprocess.check_output(['git', 'show', '{}:uisrnn/uisrnn.py'.format(reference)], cwd=repo)
+        path = os.path.join(tempfile.mkdtemp(), 'uisrnn_reference.py')
+        with open(path, 'wb') as f:
+            f.write(source)
+    spec = importlib.util.spec_from_file_location('uisrnn_reference', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run(uisrnn_model, feats, inference_args):
+    start = timer()
+    labels = uisrnn_model.predict(feats, inference_args)
+    return list(labels), timer() - start
+
+def load_model(model_class, model_path, num_speakers):
+    sys.argv = sys.argv[:1]
+    model_args, _, inference_args = uisrnn.parse_arguments()
+    model_args.observation_dim = 512
+    model_args.verbosity = 0
+    uisrnn_model = model_class(model_args)
+    uisrnn_model.load(model_path)
+    inference_args.num_speaker = num_speakers
+    return uisrnn_model, inference_args
+
+def main(args):
+    uisrnn_model, inference_args = load_model(uisrnn.UISRNN, args.model, args.num_speakers)
+    # the tiled mode times the original implementation, not the current one run the old way
+    baseline_model, _ = load_model(load_reference(args.reference).UISRNN, args.model, args.num_speakers)
+
+    if args.feats:
+        feats, truth = np.load(args.feats).astype(float), None
+    else:
+        feats, truth = synthetic_sequence(args.length, args.num_speakers or 4)
+
+    modes = [('tiled x{} (baseline)'.format(args.test_iteration), baseline_model, args.test_iteration, 0),
+             ('single pass', uisrnn_model, 1, 0)]
+    modes += [('warm-up prefix {}'.format(w), uisrnn_model, args.test_iteration, w) for w in args.warmup_lengths]
+
+    reference = None
+    print('{:<24}{:>10}{:>16}{:>16}'.format('mode', 'seconds', 'vs baseline', 'vs truth'))
+    for name, model, test_iteration, warmup_length in modes:
+        mode_args = copy.copy(inference_args)
+        mode_args.test_iteration = test_iteration
+        mode_args.warmup_length = warmup_length
+        labels, seconds = run(model, feats, mode_args)
+        if reference is None:
+            reference = labels
+        agreement = uisrnn.compute_sequence_match_accuracy(labels, reference)
+        accuracy = uisrnn.compute_sequence_match_accuracy(labels, truth) if truth else float('nan')
+        print('{:<24}{:>10.2f}{:>16.4f}{:>16.4f}'.format(name, seconds, agreement, accuracy))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare UIS-RNN inference time and accuracy of test_iteration modes.')
+    parser.add_argument('--model', default=UISRNN_PATH)
+    parser.add_argument('--reference', default='',
+                        help='uisrnn.py file or git revision of the baseline implementation; '
+                             'empty for the root commit')
+    parser.add_argument('--feats', default='',
+                        help='.npy file of d-vectors (N x 512); a synthetic sequence is used when empty')
+    parser.add_argument('--length', type=int, default=300,
+                        help='length of the synthetic sequence')
+    parser.add_argument('--num_speakers', type=int, default=4)
+    parser.add_argument('--test_iteration', type=int, default=2)
+    parser.add_argument('--warmup_lengths', type=int, nargs='*', default=[30, 100])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,60 @@
+import sys
+import argparse
+import numpy as np
+import librosa
+import diarization
+
+def reference_magnitude(wav, n_fft, win_len, hop_len, pad_mode):
+    """The magnitude spectrogram as get_magnitude computed it before it was chunked."""
+    linear = librosa.stft(wav, n_fft=n_fft, win_length=win_len, hop_length=hop_len, pad_mode=pad_mode)
+    mag, _ = librosa.magphase(linear.T)
+    return mag
+
+def chunked_magnitude(wav, chunk_size, n_fft, win_len, hop_len, pad_mode):
+    chunks = (wav[start:start + chunk_size] for start in range(0, len(wav), chunk_size))
+    blocks = list(diarization.stft_magnitude_frames(chunks, n_fft, win_len, hop_len, pad_mode=pad_mode))
+    return np.concatenate(blocks) if blocks else np.zeros((0, n_fft // 2 + 1), dtype=np.float32)
+
+def main(args):
+    rng = np.random.RandomState(args.seed)
+    mismatches = 0
+    print('{:<10}{:>10}{:>12}{:>10}{:>14}'.format('pad_mode', 'length', 'chunk', 'frames', 'max abs diff'))
+    for pad_mode in args.pad_modes:
+        for length in args.lengths:
+            wav = rng.uniform(-1, 1, length).astype(np.float32)
+            try:
+                expected = reference_magnitude(wav, args.n_fft, args.win_len, args.hop_len, pad_mode)
+            except librosa.util.exceptions.ParameterError:
+                # e.g. reflect padding of a signal shorter than the padding
+                continue
+            for chunk_size in args.chunk_sizes:
+                if -(-length // chunk_size) > args.max_chunks:
+                    continue
+                actual = chunked_magnitude(wav, chunk_size, args.n_fft, args.win_len, args.hop_len, pad_mode)
+                same = actual.shape == expected.shape and np.array_equal(actual, expected)
+                diff = np.max(np.abs(actual - expected)) if actual.shape == expected.shape and actual.size else 0.0
+                if not same:
+                    mismatches += 1
+                    print('{:<10}{:>10}{:>12}{:>10}{:>14.3g}  MISMATCH {} vs {}'.format(
+                        pad_mode, length, chunk_size, len(actual), diff, actual.shape, expected.shape))
+                elif args.verbose:
+                    print('{:<10}{:>10}{:>12}{:>10}{:>14.3g}'.format(pad_mode, length, chunk_size, len(actual), diff))
+    print('{} mismatch(es)'.format(mismatches))
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the chunked STFT of diarization.stft_magnitude_frames '
+                                                 'is bit-identical to librosa.stft followed by magphase.')
+    parser.add_argument('--lengths', type=int, nargs='*',
+                        default=[1, 2, 100, 255, 256, 257, 399, 400, 511, 512, 513, 1000, 16000, 48161, 123457])
+    parser.add_argument('--chunk_sizes', type=int, nargs='*', default=[1, 7, 160, 161, 1000, 4096, 1 << 20])
+    parser.add_argument('--max_chunks', type=int, default=20000,
+                        help='skip chunk sizes that split a signal into more chunks than this, to bound run time')
+    parser.add_argument('--pad_modes', nargs='*', default=['constant', 'reflect'])
+    parser.add_argument('--n_fft', type=int, default=512)
+    parser.add_argument('--win_len', type=int, default=400)
+    parser.add_argument('--hop_len', type=int, default=160)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='print matching cases too')
+    args = parser.parse_args()
+    sys.exit(1 if main(args) else 0)
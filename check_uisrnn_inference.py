@@ -0,0 +1,93 @@
+import os
+import sys
+import copy
+import argparse
+import uisrnn
+from benchmark_uisrnn_inference import UISRNN_PATH, synthetic_sequence, load_reference
+
+def load_model(model_class, model_path):
+    sys.argv = sys.argv[:1]
+    model_args, _, inference_args = uisrnn.parse_arguments()
+    model_args.observation_dim = 512
+    model_args.verbosity = 0
+    model_args.device = 'cpu'
+    model = model_class(model_args)
+    model.load(model_path)
+    return model, inference_args
+
+def online_labels(model, feats, inference_args, chunk_len):
+    """Labels of the best beam after feeding `feats` to predict_online in chunks."""
+    beam_set = None
+    for start in range(0, len(feats), chunk_len):
+        _, beam_set = model.predict_online(feats[start:start + chunk_len], inference_args, beam_set)
+    return list(beam_set[0].recent_trace(len(feats)))
+
+def main(args):
+    # both implementations on the CPU, so they do the same arithmetic
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    reference_module = load_reference(args.reference)
+    reference_model, inference_args = load_model(reference_module.UISRNN, args.model)
+    model, _ = load_model(uisrnn.UISRNN, args.model)
+    sequences = [synthetic_sequence(length, args.true_speakers, seed=seed)[0]
+                 for seed, length in enumerate(args.lengths)]
+
+    mismatches = 0
+    print('{:<12}{:>12}{:>16}  {}'.format('look_ahead', 'num_speaker', 'test_iteration', 'path'))
+    for look_ahead in args.look_aheads:
+        for num_speaker in args.num_speakers:
+            for test_iteration in args.test_iterations:
+                case_args = copy.copy(inference_args)
+                case_args.look_ahead = look_ahead
+                case_args.num_speaker = num_speaker
+                case_args.test_iteration = test_iteration
+                case_args.beam_size = args.beam_size
+                expected = [list(reference_model.predict_single(feats, case_args)) for feats in sequences]
+
+                results = [('predict_single', [list(model.predict_single(feats, case_args))
+                                               for feats in sequences]),
+                           ('predict_batch', [list(labels) for labels in model.predict_batch(sequences, case_args)])]
+                pooled_args = copy.copy(case_args)
+                pooled_args.predict_workers = args.predict_workers
+                results.append(('pooled', [list(labels) for labels in model.predict_batch(sequences, pooled_args)]))
+                if test_iteration == 1:
+                    # predict_online never duplicates the sequence
+                    for chunk_len in args.online_chunks:
+                        # whole look ahead groups, so chunks split the sequence where the reference does
+                        chunk_len *= look_ahead
+                        results.append(('online/{}'.format(chunk_len),
+                                        [online_labels(model, feats, case_args, chunk_len) for feats in sequences]))
+
+                # labels must match exactly. Scores are float32 on every path, as in the reference, but the
+                # batched paths sum the squared error where the reference takes its mean times D, so two
+                # candidates within float32 rounding of each other may still rank differently; on real
+                # d-vectors such ties are rare, and a mismatch is worth a look before it is dismissed.
+                for path, labels in results:
+                    same = labels == expected
+                    if not same:
+                        mismatches += 1
+                    if not same or args.verbose:
+                        print('{:<12}{:>12}{:>16}  {}{}'.format(look_ahead, num_speaker, test_iteration, path,
+                                                                '' if same else '  MISMATCH'))
+    print('{} mismatch(es)'.format(mismatches))
+    return mismatches
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that every UIS-RNN inference path gives the labels of a '
+                                                 'reference implementation of the beam search.')
+    parser.add_argument('--model', default=UISRNN_PATH)
+    parser.add_argument('--reference', default='',
+                        help='reference uisrnn/uisrnn.py file or git revision; the root commit when empty')
+    parser.add_argument('--lengths', type=int, nargs='*', default=[1, 9, 40, 75],
+                        help='lengths of the synthetic test sequences')
+    parser.add_argument('--true_speakers', type=int, default=3,
+                        help='speakers of the synthetic test sequences')
+    parser.add_argument('--num_speakers', type=int, nargs='*', default=[0, 1, 2, 5])
+    parser.add_argument('--look_aheads', type=int, nargs='*', default=[1, 2])
+    parser.add_argument('--test_iterations', type=int, nargs='*', default=[1, 2])
+    parser.add_argument('--beam_size', type=int, default=10)
+    parser.add_argument('--predict_workers', type=int, default=2)
+    parser.add_argument('--online_chunks', type=int, nargs='*', default=[1, 7, 1000],
+                        help='chunk lengths, in look ahead groups, the sequences are fed to predict_online in')
+    parser.add_argument('--verbose', action='store_true', help='print matching cases too')
+    args = parser.parse_args()
+    sys.exit(1 if main(args) else 0)
@@ -1,36 +1,126 @@
 import os
 import argparse
-from tools import wavTranscriber 
+from tools import wavTranscriber, wavSplit, featureCache, featureFrontend, runtimeConfig
 import diarization
 from timeit import default_timer as timer
 from tqdm import tqdm 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
-def main(args):
-    start = timer()  
-    vad_segments, sample_rate, audio_length = wavTranscriber.vad_segment_generator(args.audio_file,
-                                                                               aggressiveness=3,
-                                                                               frame_duration_ms=30,
-                                                                               padding_duration_ms=args.pad_silence_ms)
-    segments = diarization.diarize(args, vad_segments, 
-                                   embedding_per_sec=1,
-                                   overlap_rate=0.4)
-    joined_segments = wavTranscriber.arrange_segments(segments)
-        
+def output_target(args, audio_file, output_name=None):
+    """Path of the transcript file or audio segment directory for `audio_file`.
+
+    Outputs are named `output_name`, by default the name of the file without extension.
+    """
+    output_name = output_name or os.path.splitext(os.path.basename(audio_file))[0]
+    if args.opt == 'text':
+        return os.path.join(args.output_path, output_name + '_{}s_{}pad.txt'.format(args.num_speakers,
+                                                                                   args.pad_silence_ms))
+    if args.opt in ('rttm', 'json'):
+        return os.path.join(args.output_path, output_name + '.' + args.opt)
+    return os.path.join(args.output_path, output_name)
+
+def window_labels(segments, labels, embedding_per_sec, overlap_rate):
+    """(begin, end, label) in recording time of every utterance window."""
+    begins, ends = diarization.window_times(segments, len(labels), embedding_per_sec, overlap_rate)
+    return list(zip(begins, ends, labels))
+
+def write_results(args, audio_file, joined_segments, sample_rate, frontend=None, segments=None, windows=None,
+                  output_name=None):
+    """Write the output selected by `args.opt`.
+
+    'rttm' and 'json' need the VAD `segments` (and the utterance `windows`
+    with --window_labels); they are written from timings only. The output
+    is named as `output_target` names it.
+    """
     if args.opt == 'text':
-        transcript_file = os.path.join(args.output_path, os.path.basename(args.audio_file)[:-4] + '_{}s_{}pad.txt'.format(args.num_speakers,
-                                                                                                                          args.pad_silence_ms))
         wavTranscriber.write_stt(joined_segments,
-                                 transcript_file, 
+                                 output_target(args, audio_file, output_name), 
                                  aggressive=3,
                                  sample_rate=sample_rate, 
-                                 silence_thresh = args.silence_thresh)
+                                 silence_thresh = args.silence_thresh,
+                                 frontend=frontend,
+                                 recognizer=wavTranscriber.RECOGNIZERS[args.recognizer](sample_rate),
+                                 workers=args.stt_workers,
+                                 max_requests_per_sec=args.stt_rate,
+                                 retries=args.stt_retries)
     
     elif args.opt == 'audio': 
         wavTranscriber.write_audio_segments(joined_segments,
                                             output_path=args.output_path, 
-                                            input_file_name=args.audio_file,
-                                            sample_rate= sample_rate)
+                                            input_file_name=audio_file,
+                                            sample_rate= sample_rate,
+                                            output_name=output_name)
+
+    elif args.opt in ('rttm', 'json'):
+        writer = wavTranscriber.write_rttm if args.opt == 'rttm' else wavTranscriber.write_json
+        writer(segments,
+               output_target(args, audio_file, output_name),
+               file_id=os.path.splitext(os.path.basename(audio_file))[0],
+               sample_rate=sample_rate,
+               windows=windows)
+
+def add_arguments(parser):
+    """Add the diarization and output flags shared by the demo and batch scripts to an argparse parser."""
+    group = parser.add_argument_group('diarization')
+    group.add_argument('--output_path', type=str, default="results",
+                       help='output file path')
+    group.add_argument('--num_speakers', type=int, default=10,
+                       help='manual speaker limit')
+    group.add_argument('--silence_thresh', type=float, default=0.9,
+                       help='seconds of voiced audio below which a speaker turn is transcribed as silence')
+    group.add_argument('--pad_silence_ms', type=int, default=300,
+                       help='pad silence duration in millisecond for each segment during voice activity detection')
+    group.add_argument('--opt', choices=['text', 'audio', 'rttm', 'json'], default='text',
+                       help='option mode for output result; rttm and json only write speaker timings')
+    group.add_argument('--window_labels', action='store_true',
+                       help='with --opt rttm or json, also write the label and timing of every utterance window '
+                            '(rttm: one line per window instead of per segment)')
+    group.add_argument('--recognizer', choices=['google', 'stub'], default='google',
+                       help='speech recognizer of --opt text; stub writes empty transcripts without network access')
+    group.add_argument('--stt_workers', type=int, default=8,
+                       help='concurrent speech recognition requests')
+    group.add_argument('--stt_rate', type=float, default=0,
+                       help='maximum speech recognition requests per second, 0 for no limit')
+    group.add_argument('--stt_retries', type=int, default=3,
+                       help='retries of a speech recognition request that failed with a transient error')
+    group.add_argument('--batch_size', type=int, default=32,
+                       help='number of utterance windows per ghostvlad predict call')
+    group.add_argument('--ghostvlad_tflite', type=str, default='',
+                       help='quantized GhostVLAD from ghostvlad/quantize_inference.py to embed with')
+    group.add_argument('--audio_cache_dir', type=str, default=wavSplit.NORMALIZED_AUDIO_DIR,
+                       help='directory of decoded 16 kHz mono copies of non-wav or non-canonical inputs')
+    group.add_argument('--feature_cache_dir', type=str, default='',
+                       help='cache VAD segments, spectrograms and d-vectors here so that runs differing only in '
+                            'clustering or output options skip those stages; disabled when empty')
+    return group
+
+def main(args, diarizer=None):
+    start = timer()  
+    feature_cache = None
+    if args.feature_cache_dir:
+        feature_cache = featureCache.FeatureCache(args.feature_cache_dir, args.audio_file)
+    frontend = featureFrontend.FeatureFrontend.from_file(args.audio_file,
+                                                        aggressiveness=3,
+                                                        frame_duration_ms=30,
+                                                        cache_dir=args.audio_cache_dir,
+                                                        feature_cache=feature_cache)
+    vad_segments, sample_rate, audio_length = wavTranscriber.vad_segment_generator(args.audio_file,
+                                                                               aggressiveness=3,
+                                                                               frame_duration_ms=30,
+                                                                               padding_duration_ms=args.pad_silence_ms,
+                                                                               cache_dir=args.audio_cache_dir,
+                                                                               feature_cache=feature_cache,
+                                                                               frontend=frontend)
+    segments, labels = diarization.diarize(args, vad_segments, 
+                                           embedding_per_sec=1,
+                                           overlap_rate=0.4,
+                                           batch_size=args.batch_size,
+                                           diarizer=diarizer,
+                                           feature_cache=feature_cache,
+                                           return_labels=True)
+    windows = window_labels(segments, labels, embedding_per_sec=1, overlap_rate=0.4) if args.window_labels else None
+    joined_segments = wavTranscriber.arrange_segments(segments)
+    write_results(args, args.audio_file, joined_segments, sample_rate, frontend, segments, windows)
   
     end = timer() - start
     print("\nFinished in {:.2f} minute(s)".format(end/60)) 
@@ -38,23 +128,21 @@ def main(args):
 
 if __name__ == '__main__': 
     parser = argparse.ArgumentParser()
-    parser.add_argument('--audio_file', default="Google's congressional hearing highlights in 11 minutes.MP3")
-    parser.add_argument('--output_path', type=str, default="results",
-                        help='output file path')
-    parser.add_argument('--num_speakers', type=int, default=10, 
-                        help='manual speaker limit')
-    parser.add_argument('--silence_thresh', type=int, default=0.9, 
-                        help='remove silence speaker segment with given threshold, default "1 second"')
-    parser.add_argument('--pad_silence_ms', type=int, default = 300,
-                        help='pad silence duration in millisecond for each segment during voice activity detection')
-    parser.add_argument('--opt', choices = ['text', 'audio'], default = 'text',
-                        help='option mode for output result')
+    parser.add_argument('--audio_file', nargs='+', default=["Google's congressional hearing highlights in 11 minutes.MP3"],
+                        help='one or more audio files, diarized with models loaded only once')
+    add_arguments(parser)
  
+    runtimeConfig.add_arguments(parser)
     args = parser.parse_args()
     audio_path = r'/home/zmh/hdd/Custom_Projects/Speaker-Diarization/test-data'
-    args.audio_file = os.path.join(audio_path, args.audio_file)     
+    audio_files = [os.path.join(audio_path, audio_file) for audio_file in args.audio_file]
     # print(args)
-    segments, joined_segments = main(args)
+    runtimeConfig.configure_from_args(args)
+    diarizer = diarization.Diarizer(batch_size=args.batch_size, uisrnn_device=args.device,
+                                    ghostvlad_tflite_path=args.ghostvlad_tflite)
+    for audio_file in audio_files:
+        args.audio_file = audio_file
+        segments, joined_segments = main(args, diarizer)
     # wavTranscriber.PrintFormat.show_segments_info(segments)
     # print()
     # wavTranscriber.PrintFormat.show_segments_info(joined_segments)
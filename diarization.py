@@ -1,12 +1,22 @@
-import math
+import os
+import copy
+import hashlib
+import inspect
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import librosa
 import uisrnn
 import sys
-sys.path.append('ghostvlad')
-import model
+from tools import runtimeConfig
 from timeit import default_timer as timer
 
+GHOSTVLAD_PATH = "ghostvlad/pretrained/weights.h5"
+# written by ghostvlad/export_inference.py; used instead of GHOSTVLAD_PATH when present
+GHOSTVLAD_EXPORT_PATH = "ghostvlad/pretrained/inference"
+UISRNN_PATH = "uisrnn/pretrained/saved_model.uisrnn_benchmark"
+# label of segments that no utterance window covers
+NO_SPEAKER = 999
+
 class Expando:
     def __init__(self, d):
         self.__d = d
@@ -15,49 +25,243 @@ class Expando:
         return self.__d[item]
 
 
+# samples decoded and transformed at a time by prepare_magnitude()
+STFT_CHUNK_SAMPLES = 1 << 20
+
+def stft_magnitude_frames(chunks, n_fft=512, win_len=400, hop_len=160, pad_mode=None, block_frames=1024):
+    """Magnitude STFT of audio arriving in chunks, as float32 blocks of shape (frames, 1 + n_fft // 2).
+
+    Frame for frame this equals `np.abs(librosa.stft(y, center=True)).T` for
+    the concatenated chunks, padded with librosa's default pad mode unless
+    `pad_mode` is given, but the complex spectrogram never exists as a whole:
+    samples the next frame still needs are carried over between chunks and
+    the phase is dropped block by block, so memory is bounded by the chunk
+    size and `block_frames`.
+    """
+    if pad_mode is None:
+        pad_mode = inspect.signature(librosa.stft).parameters['pad_mode'].default
+    fft = librosa.get_fftlib()
+    window = librosa.util.pad_center(librosa.filters.get_window('hann', win_len, fftbins=True), size=n_fft)
+    pad = n_fft // 2
+
+    def transform(buf, num_frames):
+        frames = as_strided(buf, shape=(num_frames, n_fft), strides=(hop_len * buf.strides[0], buf.strides[0]),
+                            writeable=False)
+        for start in range(0, num_frames, block_frames):
+            stop = min(start + block_frames, num_frames)
+            # same precision steps as librosa: float64 windowing, complex64 spectrum
+            yield np.abs(fft.rfft(window * frames[start:stop], axis=-1).astype(np.complex64))
+
+    buf = np.zeros(0, dtype=np.float32)
+    started = False
+    for chunk in chunks:
+        buf = np.concatenate([buf, chunk])
+        if not started:
+            # the start padding may mirror up to `pad` + 1 samples
+            if len(buf) <= pad:
+                continue
+            buf = np.pad(buf, (pad, 0), mode=pad_mode)
+            started = True
+        # keep what the following frames and the end padding still need
+        num_frames = (len(buf) - max(n_fft, pad + 1)) // hop_len + 1
+        if num_frames > 0:
+            yield from transform(buf, num_frames)
+            buf = buf[num_frames * hop_len:]
+    if not started:
+        if len(buf) == 0:
+            return
+        buf = np.pad(buf, pad, mode=pad_mode)
+    else:
+        buf = np.pad(buf, (0, pad), mode=pad_mode)
+    if len(buf) >= n_fft:
+        yield from transform(buf, (len(buf) - n_fft) // hop_len + 1)
+
 def get_magnitude(wav, win_len, hop_len):
-    linear = librosa.stft(wav, n_fft=512, win_length=win_len, hop_length=hop_len)
-    mag, phase = librosa.magphase(linear.T)
-    return mag
+    blocks = list(stft_magnitude_frames([np.asarray(wav, dtype=np.float32)], 512, win_len, hop_len))
+    return np.concatenate(blocks) if blocks else np.zeros((0, 257), dtype=np.float32)
 
 def get_utterances_spec(mag, sr, hop_len, embedding_per_sec, overlap_rate):
+    """Frame the magnitude spectrogram into normalized sliding windows.
+
+    Returns one (N, 257, W) array. Normalization is per time frame, so the
+    spectrogram is normalized once and the windows are strided views over it
+    (a gather is used only when fractional hops make the starts uneven).
+    Window starts keep the `int(slide + 0.5)` rounding of the original loop;
+    every window is `int(spec_len + 0.5)` frames wide.
+    """
     mag_T = mag.T
     freq, time = mag_T.shape
     spec_len = sr / hop_len / embedding_per_sec
     spec_hop_len = spec_len * (1 - overlap_rate)
-    cur_slide = 0.0
-    utterances_spec = []
+    win_width = int(spec_len + 0.5)
+    if spec_len > time:
+        return np.zeros((0, freq, win_width), dtype=mag.dtype)
 
-    while (True):
-        if cur_slide + spec_len > time:
-            break
+    # accumulate the hop the same way the original loop did, so fractional
+    # hops round to the same frame indices
+    max_windows = int((time - spec_len) / spec_hop_len) + 2
+    slides = np.cumsum(np.append(0.0, np.full(max_windows - 1, spec_hop_len)))
+    slides = slides[slides + spec_len <= time]
+    starts = np.minimum((slides + 0.5).astype(int), time - win_width)
 
-        spec_mag = mag_T[:, int(cur_slide + 0.5):int(cur_slide + spec_len + 0.5)]
-        mu = np.mean(spec_mag, 0, keepdims=True)
-        std = np.std(spec_mag, 0, keepdims=True)
-        spec_mag = (spec_mag - mu) / (std + 1e-5)
-        utterances_spec.append(spec_mag)
-        cur_slide += spec_hop_len
+    mu = np.mean(mag_T, 0, keepdims=True)
+    std = np.std(mag_T, 0, keepdims=True)
+    mag_norm = np.ascontiguousarray((mag_T - mu) / (std + 1e-5))
 
-    return utterances_spec
+    steps = np.diff(starts)
+    row_stride, col_stride = mag_norm.strides
+    if len(steps) == 0 or np.all(steps == steps[0]):
+        step = steps[0] if len(steps) else 1
+        return as_strided(mag_norm[:, starts[0]:],
+                          shape=(len(starts), freq, win_width),
+                          strides=(step * col_stride, row_stride, col_stride),
+                          writeable=False)
+    # every window of a one-frame hop, of which the starts are gathered
+    windows = as_strided(mag_norm, shape=(time - win_width + 1, freq, win_width),
+                         strides=(col_stride, row_stride, col_stride), writeable=False)
+    return windows[starts]
+
+def prepare_magnitude(segments, win_len=400, hop_len=160, n_fft=512):
+    """Magnitude spectrogram of the voiced audio of `segments`, concatenated.
+
+    The voiced audio is decoded and transformed in chunks of
+    STFT_CHUNK_SAMPLES samples straight into the preallocated float32 result.
+    """
+    def chunks():
+        for segment in segments:
+            samples = segment.samples
+            for start in range(0, len(samples), STFT_CHUNK_SAMPLES):
+                yield librosa.util.buf_to_float(samples[start:start + STFT_CHUNK_SAMPLES])
+
+    num_samples = sum(segment.num_samples for segment in segments)
+    # centered frames: one per hop, plus the one at sample 0
+    mag = np.empty((num_samples // hop_len + 1 if num_samples else 0, n_fft // 2 + 1), dtype=np.float32)
+    filled = 0
+    for block in stft_magnitude_frames(chunks(), n_fft, win_len, hop_len):
+        mag[filled:filled + len(block)] = block
+        filled += len(block)
+    return mag[:filled]
+
+def cached_magnitude(segments, win_len=400, hop_len=160, feature_cache=None):
+    """`prepare_magnitude`, loaded from a `tools.featureCache.FeatureCache` when it holds it and saved to it otherwise."""
+    mag = None
+    if feature_cache is not None:
+        mag = feature_cache.load('magnitude', win_len=win_len, hop_len=hop_len)
+    if mag is None:
+        mag = prepare_magnitude(segments, win_len, hop_len)
+        if feature_cache is not None:
+            feature_cache.save('magnitude', mag, win_len=win_len, hop_len=hop_len)
+    return mag
 
 def prepare_ghostvlad_data(segments, sr=16000, win_len=400, hop_len=160, embedding_per_sec=1.0, overlap_rate=0.1):
-    active_wav = bytearray()
-    for segment in segments:
-        active_wav.extend(segment.bytes)
-    mag = get_magnitude(np.array(librosa.util.buf_to_float(np.frombuffer(active_wav, dtype=np.int16))), win_len, hop_len)
+    mag = prepare_magnitude(segments, win_len, hop_len)
     utterances_spec = get_utterances_spec(mag, sr, hop_len, embedding_per_sec, overlap_rate)
 
     return utterances_spec
 
+def extract_embeddings(ghostvlad_model, utterances_spec, batch_size=32):
+    """Extract d-vectors for fixed-width utterance windows in batches.
+
+    Windows are stacked into (B, 257, T, 1) tensors so that each batch costs
+    a single `predict` call instead of one call per window.
+    """
+    feats = []
+    for start in range(0, len(utterances_spec), batch_size):
+        batch = np.asarray(utterances_spec[start:start + batch_size])
+        batch = np.expand_dims(batch, -1)
+        feats.append(ghostvlad_model.predict(batch, batch_size=len(batch)))
+    if not feats:
+        return np.zeros((0, 512))
+    return np.concatenate(feats).astype(float)
 
-def diarize(args, segments, sr=16000, win_len=400, hop_len=160, embedding_per_sec=1.0, overlap_rate=0.1):
-    GHOSTVLAD_PATH = "ghostvlad/pretrained/weights.h5"
-    UISRNN_PATH = "uisrnn/pretrained/saved_model.uisrnn_benchmark"
-    
-    start = timer()
-    print("[INFO] Initializing dirization models")
-    # Initialize ghostvlad
+
+def segment_window_ranges(segments, num_windows, embedding_per_sec=1.0, overlap_rate=0.1):
+    """[begin, end) indices of the utterance windows each segment spans, clipped to `num_windows`.
+
+    Windows are laid over the voiced audio of `segments` concatenated, one
+    every `(1 - overlap_rate) / embedding_per_sec` seconds, so a segment spans
+    the windows between the floor and ceil of its cumulative start and end.
+    """
+    embedding_duration = (1/embedding_per_sec) * (1.0 - overlap_rate)
+    bounds = np.cumsum([0.0] + [segment.end - segment.begin for segment in segments])
+    begin = np.minimum(np.floor(bounds[:-1] / embedding_duration).astype(np.int64), num_windows)
+    end = np.minimum(np.ceil(bounds[1:] / embedding_duration).astype(np.int64), num_windows)
+    return begin, end
+
+def window_times(segments, num_windows, embedding_per_sec=1.0, overlap_rate=0.1):
+    """Recording time (begin, end) in seconds of each utterance window.
+
+    Window i starts `i * (1 - overlap_rate) / embedding_per_sec` seconds into
+    the concatenated voiced audio of `segments` and lasts `1 / embedding_per_sec`.
+    Both ends are mapped back to the recording through the cumulative segment
+    durations, so a window that straddles a pause also spans the pause.
+    """
+    if not segments:
+        return np.zeros(0), np.zeros(0)
+    bounds = np.cumsum([0.0] + [segment.end - segment.begin for segment in segments])
+    starts = np.array([segment.begin for segment in segments])
+    voiced_begin = np.arange(num_windows) * ((1/embedding_per_sec) * (1.0 - overlap_rate))
+    voiced_end = np.minimum(voiced_begin + 1/embedding_per_sec, bounds[-1])
+
+    def to_recording(times, side):
+        # an end on a segment boundary stays in the earlier segment
+        index = np.clip(np.searchsorted(bounds, times, side=side) - 1, 0, len(segments) - 1)
+        return starts[index] + (times - bounds[index])
+    return to_recording(voiced_begin, 'right'), to_recording(voiced_end, 'left')
+
+def map_labels_to_segments(segments, labels, embedding_per_sec=1.0, overlap_rate=0.1):
+    """Majority window label of each segment and the fraction of its windows that agree.
+
+    Votes are differences of cumulative per-label counts, so the cost does
+    not grow with the number of windows a segment spans. Ties go to the label
+    seen first in the segment. Segments without windows get the label NO_SPEAKER
+    and confidence 0.
+    """
+    labels = np.asarray(labels)
+    begin, end = segment_window_ranges(segments, len(labels), embedding_per_sec, overlap_rate)
+    speakers = np.full(len(segments), NO_SPEAKER, dtype=object)
+    confidence = np.zeros(len(segments))
+    if len(labels) == 0 or len(segments) == 0:
+        return speakers.tolist(), confidence
+    unique_labels, label_ids = np.unique(labels, return_inverse=True)
+    one_hot = label_ids.reshape(-1, 1) == np.arange(len(unique_labels))
+    counts = np.zeros((len(labels) + 1, len(unique_labels)), dtype=np.int64)
+    np.cumsum(one_hot, axis=0, out=counts[1:])
+    # first index at or after each window where each label occurs
+    positions = np.where(one_hot, np.arange(len(labels)).reshape(-1, 1), len(labels))
+    first_seen = np.full_like(counts, len(labels))
+    first_seen[:-1] = np.minimum.accumulate(positions[::-1], axis=0)[::-1]
+
+    votes = counts[end] - counts[begin]
+    best = np.argmax(votes * (len(labels) + 1) - first_seen[begin], axis=1)
+    rows = np.arange(len(segments))
+    total = end - begin
+    has_windows = total > 0
+    speakers[has_windows] = unique_labels[best[has_windows]].tolist()
+    confidence[has_windows] = votes[rows, best][has_windows] / total[has_windows]
+    return speakers.tolist(), confidence
+
+def assign_speakers(segments, labels, embedding_per_sec=1.0, overlap_rate=0.1):
+    """Give each VAD segment the majority label of the windows it spans.
+
+    The share of the segment's windows carrying that label is kept as
+    `segment.confidence`.
+    """
+    speakers, confidence = map_labels_to_segments(segments, labels, embedding_per_sec, overlap_rate)
+    for segment, speaker, segment_confidence in zip(segments, speakers, confidence):
+        segment.speaker = speaker
+        segment.confidence = float(segment_confidence)
+    return segments
+
+
+def load_keras_ghostvlad(weights_path):
+    """Build the GhostVLAD eval network in Keras and load its weights."""
+    import tensorflow as tf
+    import keras.backend as K
+    sys.path.append('ghostvlad')
+    import model
+    # build the graph in a session following tools.runtimeConfig
+    K.set_session(tf.compat.v1.Session(config=runtimeConfig.tensorflow_config()))
     ghostvlad_model = model.vggvox_resnet2d_icassp(input_dim=(257, None, 1),
                                                    num_class=5994,
                                                    mode="eval",
@@ -67,40 +271,222 @@ def diarize(args, segments, sr=16000, win_len=400, hop_len=160, embedding_per_se
                                                                  "ghost_cluster": 2,
                                                                  "bottleneck_dim": 512,
                                                                  "aggregation_mode": "gvlad"}))
-    ghostvlad_model.load_weights(GHOSTVLAD_PATH, by_name=True)
-
-    # Initialize uisrnn
-    sys.argv = sys.argv[:1]
-    model_args, _, inference_args = uisrnn.parse_arguments()
-    model_args.observation_dim = 512
-    inference_args.num_speaker = args.num_speakers
-    uisrnn_model = uisrnn.UISRNN(model_args)
-    uisrnn_model.load(UISRNN_PATH)
-    print("[INFO] Two models loading time : {:.2f} seconds.".format(timer()-start))
- 
-    # Extract D-vector with ghostvad
-    print('[INFO] Extracting D-Vector from utterance.')
-    utterances_spec = prepare_ghostvlad_data(segments, sr, win_len, hop_len, embedding_per_sec, overlap_rate)
-    feats = []
-    for spec in utterances_spec:
-        spec = np.expand_dims(np.expand_dims(spec, 0), -1)
-        v = ghostvlad_model.predict(spec)
-        feats += [v]
-    feats = np.array(feats)[:, 0, :].astype(float)
-
-    # Clustering on d-vector with uisrnn
-    labels = uisrnn_model.predict(feats, inference_args) 
-    embedding_duration = (1/embedding_per_sec) * (1.0 - overlap_rate)
-    labels_count = len(labels)
-    current = 0
-    for segment in segments:
-        begin_index = math.floor(current/embedding_duration)
-        current += segment.end-segment.begin
-        end_index = math.ceil(current/embedding_duration)
-        segment_labels = [labels[index] for index in range(begin_index, min(end_index, labels_count))]
-        if len(segment_labels) > 0:
-            segment.speaker = max(segment_labels, key=segment_labels.count)
+    ghostvlad_model.load_weights(weights_path, by_name=True)
+    return ghostvlad_model
+
+
+class ExportedGhostVLAD:
+    """GhostVLAD SavedModel written by ghostvlad/export_inference.py.
+
+    A frozen graph ending at the L2-normalized fc6 embedding, with BatchNorm
+    folded into the convolutions. Loading it needs neither Keras nor the
+    model code, and has the same `predict()` as the Keras model.
+    """
+    def __init__(self, export_dir):
+        import tensorflow as tf
+        self.graph = tf.Graph()
+        self.session = tf.compat.v1.Session(graph=self.graph, config=runtimeConfig.tensorflow_config())
+        meta_graph = tf.compat.v1.saved_model.loader.load(self.session,
+                                                          [tf.compat.v1.saved_model.tag_constants.SERVING],
+                                                          export_dir)
+        signature = meta_graph.signature_def['serving_default']
+        self.input = self.graph.get_tensor_by_name(signature.inputs['input'].name)
+        self.output = self.graph.get_tensor_by_name(signature.outputs['embedding'].name)
+
+    def predict(self, batch, batch_size=32):
+        return np.concatenate([self.session.run(self.output, {self.input: batch[i:i + batch_size]})
+                               for i in range(0, len(batch), batch_size)])
+
+
+class TFLiteGhostVLAD:
+    """Quantized GhostVLAD written by ghostvlad/quantize_inference.py.
+
+    Uses the standalone tflite_runtime interpreter when it is installed, so
+    TensorFlow is not imported at all; otherwise tf.lite. The model is
+    converted for one window width, only the batch dimension is resized.
+    """
+    def __init__(self, model_path):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+        kwargs = {}
+        if runtimeConfig.SETTINGS['intra_op_threads']:
+            kwargs['num_threads'] = runtimeConfig.SETTINGS['intra_op_threads']
+        self.interpreter = Interpreter(model_path=model_path, **kwargs)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.input_shape = tuple(self.input['shape'])
+
+    def predict(self, batch, batch_size=32):
+        batch = np.asarray(batch, dtype=np.float32)
+        if batch.shape[1:] != self.input_shape[1:]:
+            raise ValueError('windows of shape {} do not match the converted model input {}'.format(
+                batch.shape[1:], self.input_shape[1:]))
+        feats = []
+        for i in range(0, len(batch), batch_size):
+            chunk = batch[i:i + batch_size]
+            if chunk.shape != self.input_shape:
+                self.interpreter.resize_tensor_input(self.input['index'], chunk.shape)
+                self.interpreter.allocate_tensors()
+                self.input_shape = chunk.shape
+            self.interpreter.set_tensor(self.input['index'], chunk)
+            self.interpreter.invoke()
+            feats.append(self.interpreter.get_tensor(self.output['index']).copy())
+        return np.concatenate(feats)
+
+
+def artifact_hash(path, block_size=1 << 20):
+    """SHA-1 of a model file, or of the names and contents of every file under a model directory."""
+    if os.path.isfile(path):
+        root, paths = os.path.dirname(path), [path]
+    else:
+        root = path
+        paths = sorted(os.path.join(directory, name) for directory, _, names in os.walk(path) for name in names)
+    digest = hashlib.sha1()
+    for file_path in paths:
+        digest.update(os.path.relpath(file_path, root).encode('utf-8'))
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def export_is_current(export_dir, weights_path):
+    """True if `export_dir` holds an export written after `weights_path` last changed."""
+    graph_path = os.path.join(export_dir, 'saved_model.pb')
+    if not os.path.isfile(graph_path):
+        return False
+    return not os.path.isfile(weights_path) or os.path.getmtime(graph_path) >= os.path.getmtime(weights_path)
+
+
+class Diarizer:
+    """Keeps GhostVLAD and UIS-RNN loaded so many audio jobs can be diarized
+    without paying the model start-up cost on every call.
+    """
+    def __init__(self, ghostvlad_path=GHOSTVLAD_PATH, uisrnn_path=UISRNN_PATH, batch_size=32, warmup=True,
+                 uisrnn_device='', ghostvlad_export_path=GHOSTVLAD_EXPORT_PATH, ghostvlad_tflite_path=''):
+        start = timer()
+        print("[INFO] Initializing dirization models")
+        # Initialize ghostvlad: a quantized model if asked for, the exported
+        # inference graph of the default weights if it is up to date, else
+        # the Keras model of `ghostvlad_path`
+        use_export = (not ghostvlad_tflite_path and ghostvlad_path == GHOSTVLAD_PATH and ghostvlad_export_path
+                      and os.path.isdir(ghostvlad_export_path))
+        if use_export and not export_is_current(ghostvlad_export_path, ghostvlad_path):
+            print('[WARNING] {} is older than {}, loading the weights instead; re-run '
+                  'ghostvlad/export_inference.py to update it'.format(ghostvlad_export_path, ghostvlad_path))
+            use_export = False
+        if ghostvlad_tflite_path:
+            self.ghostvlad_model = TFLiteGhostVLAD(ghostvlad_tflite_path)
+            self.ghostvlad_path = ghostvlad_tflite_path
+        elif use_export:
+            self.ghostvlad_model = ExportedGhostVLAD(ghostvlad_export_path)
+            self.ghostvlad_path = ghostvlad_export_path
         else:
-            segment.speaker = 999
-    return segments
+            self.ghostvlad_model = load_keras_ghostvlad(ghostvlad_path)
+            self.ghostvlad_path = ghostvlad_path
+
+        # Initialize uisrnn
+        sys.argv = sys.argv[:1]
+        model_args, _, self.inference_args = uisrnn.parse_arguments()
+        model_args.observation_dim = 512
+        model_args.device = uisrnn_device
+        self.uisrnn_model = uisrnn.UISRNN(model_args)
+        self.uisrnn_model.load(uisrnn_path)
+        self.batch_size = batch_size
+        self._ghostvlad_hash = None
+        if warmup:
+            self.warmup()
+        print("[INFO] Two models loading time : {:.2f} seconds.".format(timer()-start))
+
+    @property
+    def ghostvlad_hash(self):
+        """Content hash of the loaded GhostVLAD model, which keys its cached d-vectors."""
+        if self._ghostvlad_hash is None:
+            self._ghostvlad_hash = artifact_hash(self.ghostvlad_path)
+        return self._ghostvlad_hash
+
+    def warmup(self, spec_len=100):
+        """Run one dummy batch so the first real job does not pay graph set-up."""
+        dummy = np.zeros((1, 257, spec_len, 1), dtype=np.float32)
+        self.ghostvlad_model.predict(dummy)
+
+    def embed(self, utterances_spec):
+        return extract_embeddings(self.ghostvlad_model, utterances_spec, batch_size=self.batch_size)
+
+    def cluster(self, feats, num_speakers=0):
+        inference_args = copy.copy(self.inference_args)
+        inference_args.num_speaker = num_speakers
+        return self.uisrnn_model.predict(feats, inference_args)
+
+    def cluster_online(self, feats, num_speakers=0, beam_set=None):
+        """Cluster newly arrived d-vectors, continuing from `beam_set`."""
+        inference_args = copy.copy(self.inference_args)
+        inference_args.num_speaker = num_speakers
+        return self.uisrnn_model.predict_online(feats, inference_args, beam_set)
+
+    def diarize(self, segments, num_speakers=0, sr=16000, win_len=400, hop_len=160, embedding_per_sec=1.0, overlap_rate=0.1,
+                feature_cache=None, return_labels=False):
+        """Label `segments` by speaker.
+
+        With a `tools.featureCache.FeatureCache`, the magnitude spectrogram
+        and the d-vectors are loaded from it when their parameters match,
+        so only clustering is re-run. With `return_labels`, the label of
+        every utterance window is returned with the segments.
+        """
+        def make_windows():
+            mag = cached_magnitude(segments, win_len, hop_len, feature_cache)
+            # Extract D-vector with ghostvad
+            print('[INFO] Extracting D-Vector from utterance.')
+            return get_utterances_spec(mag, sr, hop_len, embedding_per_sec, overlap_rate)
+        feats = self.embed_cached(make_windows, feature_cache, sr=sr, win_len=win_len, hop_len=hop_len,
+                                  embedding_per_sec=embedding_per_sec, overlap_rate=overlap_rate)
+        return self.label_segments(segments, feats, num_speakers, embedding_per_sec, overlap_rate, return_labels)
+
+    def diarize_windows(self, segments, utterances_spec, num_speakers=0, embedding_per_sec=1.0, overlap_rate=0.1,
+                        return_labels=False, feature_cache=None, sr=16000, win_len=400, hop_len=160):
+        """Label `segments` from utterance windows that were framed elsewhere.
+
+        With a `tools.featureCache.FeatureCache`, the d-vectors are cached as
+        in `diarize()`; `sr`, `win_len` and `hop_len` are those the windows
+        were framed with and are part of the key.
+        """
+        feats = self.embed_cached(lambda: utterances_spec, feature_cache, sr=sr, win_len=win_len, hop_len=hop_len,
+                                  embedding_per_sec=embedding_per_sec, overlap_rate=overlap_rate)
+        return self.label_segments(segments, feats, num_speakers, embedding_per_sec, overlap_rate, return_labels)
+
+    def embed_cached(self, make_windows, feature_cache=None, **window_params):
+        """D-vectors of the windows `make_windows()` returns, kept in `feature_cache` if given.
+
+        Cached d-vectors are keyed by the model content and `window_params`;
+        the windows are only built when none are cached.
+        """
+        feats = None
+        if feature_cache is not None:
+            feats = feature_cache.load('embeddings', ghostvlad=self.ghostvlad_hash, **window_params)
+        if feats is None:
+            feats = self.embed(make_windows())
+            if feature_cache is not None:
+                feature_cache.save('embeddings', feats, ghostvlad=self.ghostvlad_hash, **window_params)
+        return feats
+
+    def label_segments(self, segments, feats, num_speakers=0, embedding_per_sec=1.0, overlap_rate=0.1,
+                       return_labels=False):
+        # Clustering on d-vector with uisrnn
+        labels = self.cluster(np.asarray(feats), num_speakers)
+        segments = assign_speakers(segments, labels, embedding_per_sec, overlap_rate)
+        if return_labels:
+            return segments, labels
+        return segments
+
 
+def diarize(args, segments, sr=16000, win_len=400, hop_len=160, embedding_per_sec=1.0, overlap_rate=0.1, batch_size=32, diarizer=None,
+            feature_cache=None, return_labels=False):
+    """Diarize `segments`, loading both models unless a `Diarizer` is given."""
+    if diarizer is None:
+        diarizer = Diarizer(batch_size=batch_size)
+    return diarizer.diarize(segments, args.num_speakers, sr, win_len, hop_len, embedding_per_sec, overlap_rate,
+                            feature_cache=feature_cache, return_labels=return_labels)
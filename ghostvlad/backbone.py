@@ -10,7 +10,27 @@ from keras.layers import MaxPooling2D, AveragePooling2D, GlobalAveragePooling2D
 weight_decay = 1e-4
 
 
-def identity_block_2D(input_tensor, kernel_size, filters, stage, block, trainable=True):
+def conv_bn_2D(input_tensor, filters, kernel_size, name, trainable=True, fold_bn=False, **kwargs):
+    """Conv2D followed by its BatchNormalization, named `name` and `name + '/bn'`.
+    # Arguments
+        fold_bn: leave the BatchNormalization out and give the convolution a bias
+            instead, to hold the folded weights (see export_inference.py).
+    # Returns
+        Output tensor.
+    """
+    x = Conv2D(filters, kernel_size,
+               kernel_initializer='orthogonal',
+               use_bias=fold_bn,
+               trainable=trainable,
+               kernel_regularizer=l2(weight_decay),
+               name=name,
+               **kwargs)(input_tensor)
+    if not fold_bn:
+        x = BatchNormalization(axis=3, trainable=trainable, name=name + '/bn')(x)
+    return x
+
+
+def identity_block_2D(input_tensor, kernel_size, filters, stage, block, trainable=True, fold_bn=False):
     """The identity block is the block that has no conv layer at shortcut.
     # Arguments
         input_tensor: input tensor
@@ -18,51 +38,29 @@ def identity_block_2D(input_tensor, kernel_size, filters, stage, block, trainabl
         filters: list of integers, the filterss of 3 conv layer at main path
         stage: integer, current stage label, used for generating layer names
         block: 'a','b'..., current block label, used for generating layer names
+        fold_bn: build the convolutions with biases and without BatchNormalization
     # Returns
         Output tensor for the block.
     """
     filters1, filters2, filters3 = filters
-    bn_axis = 3
 
     conv_name_1 = 'conv' + str(stage) + '_' + str(block) + '_1x1_reduce'
-    bn_name_1 = 'conv' + str(stage) + '_' + str(block) + '_1x1_reduce/bn'
-    x = Conv2D(filters1, (1, 1),
-               kernel_initializer='orthogonal',
-               use_bias=False,
-               trainable=trainable,
-               kernel_regularizer=l2(weight_decay),
-               name=conv_name_1)(input_tensor)
-    x = BatchNormalization(axis=bn_axis, trainable=trainable, name=bn_name_1)(x)
+    x = conv_bn_2D(input_tensor, filters1, (1, 1), conv_name_1, trainable=trainable, fold_bn=fold_bn)
     x = Activation('relu')(x)
 
     conv_name_2 = 'conv' + str(stage) + '_' + str(block) + '_3x3'
-    bn_name_2 = 'conv' + str(stage) + '_' + str(block) + '_3x3/bn'
-    x = Conv2D(filters2, kernel_size,
-               padding='same',
-               kernel_initializer='orthogonal',
-               use_bias=False,
-               trainable=trainable,
-               kernel_regularizer=l2(weight_decay),
-               name=conv_name_2)(x)
-    x = BatchNormalization(axis=bn_axis, trainable=trainable, name=bn_name_2)(x)
+    x = conv_bn_2D(x, filters2, kernel_size, conv_name_2, trainable=trainable, fold_bn=fold_bn, padding='same')
     x = Activation('relu')(x)
 
     conv_name_3 = 'conv' + str(stage) + '_' + str(block) + '_1x1_increase'
-    bn_name_3 = 'conv' + str(stage) + '_' + str(block) + '_1x1_increase/bn'
-    x = Conv2D(filters3, (1, 1),
-               kernel_initializer='orthogonal',
-               use_bias=False,
-               trainable=trainable,
-               kernel_regularizer=l2(weight_decay),
-               name=conv_name_3)(x)
-    x = BatchNormalization(axis=bn_axis, trainable=trainable, name=bn_name_3)(x)
+    x = conv_bn_2D(x, filters3, (1, 1), conv_name_3, trainable=trainable, fold_bn=fold_bn)
 
     x = layers.add([x, input_tensor])
     x = Activation('relu')(x)
     return x
 
 
-def conv_block_2D(input_tensor, kernel_size, filters, stage, block, strides=(2, 2), trainable=True):
+def conv_block_2D(input_tensor, kernel_size, filters, stage, block, strides=(2, 2), trainable=True, fold_bn=False):
     """A block that has a conv layer at shortcut.
     # Arguments
         input_tensor: input tensor
@@ -70,64 +68,34 @@ def conv_block_2D(input_tensor, kernel_size, filters, stage, block, strides=(2,
         filters: list of integers, the filterss of 3 conv layer at main path
         stage: integer, current stage label, used for generating layer names
         block: 'a','b'..., current block label, used for generating layer names
+        fold_bn: build the convolutions with biases and without BatchNormalization
     # Returns
         Output tensor for the block.
     Note that from stage 3, the first conv layer at main path is with strides=(2,2)
     And the shortcut should have strides=(2,2) as well
     """
     filters1, filters2, filters3 = filters
-    bn_axis = 3
 
     conv_name_1 = 'conv' + str(stage) + '_' + str(block) + '_1x1_reduce'
-    bn_name_1 = 'conv' + str(stage) + '_' + str(block) + '_1x1_reduce/bn'
-    x = Conv2D(filters1, (1, 1),
-               strides=strides,
-               kernel_initializer='orthogonal',
-               use_bias=False,
-               trainable=trainable,
-               kernel_regularizer=l2(weight_decay),
-               name=conv_name_1)(input_tensor)
-    x = BatchNormalization(axis=bn_axis, trainable=trainable, name=bn_name_1)(x)
+    x = conv_bn_2D(input_tensor, filters1, (1, 1), conv_name_1, trainable=trainable, fold_bn=fold_bn, strides=strides)
     x = Activation('relu')(x)
 
     conv_name_2 = 'conv' + str(stage) + '_' + str(block) + '_3x3'
-    bn_name_2 = 'conv' + str(stage) + '_' + str(block) + '_3x3/bn'
-    x = Conv2D(filters2, kernel_size, padding='same',
-               kernel_initializer='orthogonal',
-               use_bias=False,
-               trainable=trainable,
-               kernel_regularizer=l2(weight_decay),
-               name=conv_name_2)(x)
-    x = BatchNormalization(axis=bn_axis, trainable=trainable, name=bn_name_2)(x)
+    x = conv_bn_2D(x, filters2, kernel_size, conv_name_2, trainable=trainable, fold_bn=fold_bn, padding='same')
     x = Activation('relu')(x)
 
     conv_name_3 = 'conv' + str(stage) + '_' + str(block) + '_1x1_increase'
-    bn_name_3 = 'conv' + str(stage) + '_' + str(block) + '_1x1_increase/bn'
-    x = Conv2D(filters3, (1, 1),
-               kernel_initializer='orthogonal',
-               use_bias=False,
-               trainable=trainable,
-               kernel_regularizer=l2(weight_decay),
-               name=conv_name_3)(x)
-    x = BatchNormalization(axis=bn_axis, trainable=trainable, name=bn_name_3)(x)
+    x = conv_bn_2D(x, filters3, (1, 1), conv_name_3, trainable=trainable, fold_bn=fold_bn)
 
     conv_name_4 = 'conv' + str(stage) + '_' + str(block) + '_1x1_proj'
-    bn_name_4 = 'conv' + str(stage) + '_' + str(block) + '_1x1_proj/bn'
-    shortcut = Conv2D(filters3, (1, 1), strides=strides,
-                      kernel_initializer='orthogonal',
-                      use_bias=False,
-                      trainable=trainable,
-                      kernel_regularizer=l2(weight_decay),
-                      name=conv_name_4)(input_tensor)
-    shortcut = BatchNormalization(axis=bn_axis, trainable=trainable, name=bn_name_4)(shortcut)
+    shortcut = conv_bn_2D(input_tensor, filters3, (1, 1), conv_name_4, trainable=trainable, fold_bn=fold_bn, strides=strides)
 
     x = layers.add([x, shortcut])
     x = Activation('relu')(x)
     return x
 
 
-def resnet_2D_v1(input_dim, mode='train'):
-    bn_axis = 3
+def resnet_2D_v1(input_dim, mode='train', fold_bn=False):
     if mode == 'train':
         inputs = Input(shape=input_dim, name='input')
     else:
@@ -135,47 +103,39 @@ def resnet_2D_v1(input_dim, mode='train'):
     # ===============================================
     #            Convolution Block 1
     # ===============================================
-    x1 = Conv2D(64, (7, 7),
-                kernel_initializer='orthogonal',
-                use_bias=False, trainable=True,
-                kernel_regularizer=l2(weight_decay),
-                padding='same',
-                name='conv1_1/3x3_s1')(inputs)
-
-    x1 = BatchNormalization(axis=bn_axis, name='conv1_1/3x3_s1/bn', trainable=True)(x1)
+    x1 = conv_bn_2D(inputs, 64, (7, 7), 'conv1_1/3x3_s1', trainable=True, fold_bn=fold_bn, padding='same')
     x1 = Activation('relu')(x1)
     x1 = MaxPooling2D((2, 2), strides=(2, 2))(x1)
 
     # ===============================================
     #            Convolution Section 2
     # ===============================================
-    x2 = conv_block_2D(x1, 3, [48, 48, 96], stage=2, block='a', strides=(1, 1), trainable=True)
-    x2 = identity_block_2D(x2, 3, [48, 48, 96], stage=2, block='b', trainable=True)
+    x2 = conv_block_2D(x1, 3, [48, 48, 96], stage=2, block='a', strides=(1, 1), trainable=True, fold_bn=fold_bn)
+    x2 = identity_block_2D(x2, 3, [48, 48, 96], stage=2, block='b', trainable=True, fold_bn=fold_bn)
 
     # ===============================================
     #            Convolution Section 3
     # ===============================================
-    x3 = conv_block_2D(x2, 3, [96, 96, 128], stage=3, block='a', trainable=True)
-    x3 = identity_block_2D(x3, 3, [96, 96, 128], stage=3, block='b', trainable=True)
-    x3 = identity_block_2D(x3, 3, [96, 96, 128], stage=3, block='c', trainable=True)
+    x3 = conv_block_2D(x2, 3, [96, 96, 128], stage=3, block='a', trainable=True, fold_bn=fold_bn)
+    x3 = identity_block_2D(x3, 3, [96, 96, 128], stage=3, block='b', trainable=True, fold_bn=fold_bn)
+    x3 = identity_block_2D(x3, 3, [96, 96, 128], stage=3, block='c', trainable=True, fold_bn=fold_bn)
     # ===============================================
     #            Convolution Section 4
     # ===============================================
-    x4 = conv_block_2D(x3, 3, [128, 128, 256], stage=4, block='a', trainable=True)
-    x4 = identity_block_2D(x4, 3, [128, 128, 256], stage=4, block='b', trainable=True)
-    x4 = identity_block_2D(x4, 3, [128, 128, 256], stage=4, block='c', trainable=True)
+    x4 = conv_block_2D(x3, 3, [128, 128, 256], stage=4, block='a', trainable=True, fold_bn=fold_bn)
+    x4 = identity_block_2D(x4, 3, [128, 128, 256], stage=4, block='b', trainable=True, fold_bn=fold_bn)
+    x4 = identity_block_2D(x4, 3, [128, 128, 256], stage=4, block='c', trainable=True, fold_bn=fold_bn)
     # ===============================================
     #            Convolution Section 5
     # ===============================================
-    x5 = conv_block_2D(x4, 3, [256, 256, 512], stage=5, block='a', trainable=True)
-    x5 = identity_block_2D(x5, 3, [256, 256, 512], stage=5, block='b', trainable=True)
-    x5 = identity_block_2D(x5, 3, [256, 256, 512], stage=5, block='c', trainable=True)
+    x5 = conv_block_2D(x4, 3, [256, 256, 512], stage=5, block='a', trainable=True, fold_bn=fold_bn)
+    x5 = identity_block_2D(x5, 3, [256, 256, 512], stage=5, block='b', trainable=True, fold_bn=fold_bn)
+    x5 = identity_block_2D(x5, 3, [256, 256, 512], stage=5, block='c', trainable=True, fold_bn=fold_bn)
     y = MaxPooling2D((3, 1), strides=(2, 1), name='mpool2')(x5)
     return inputs, y
 
 
-def resnet_2D_v2(input_dim, mode='train'):
-    bn_axis = 3
+def resnet_2D_v2(input_dim, mode='train', fold_bn=False):
     if mode == 'train':
         inputs = Input(shape=input_dim, name='input')
     else:
@@ -183,41 +143,35 @@ def resnet_2D_v2(input_dim, mode='train'):
     # ===============================================
     #            Convolution Block 1
     # ===============================================
-    x1 = Conv2D(64, (7, 7), strides=(2, 2),
-                kernel_initializer='orthogonal',
-                use_bias=False, trainable=True,
-                kernel_regularizer=l2(weight_decay),
-                padding='same',
-                name='conv1_1/3x3_s1')(inputs)
-
-    x1 = BatchNormalization(axis=bn_axis, name='conv1_1/3x3_s1/bn', trainable=True)(x1)
+    x1 = conv_bn_2D(inputs, 64, (7, 7), 'conv1_1/3x3_s1', trainable=True, fold_bn=fold_bn,
+                    strides=(2, 2), padding='same')
     x1 = Activation('relu')(x1)
     x1 = MaxPooling2D((2, 2), strides=(2, 2))(x1)
 
     # ===============================================
     #            Convolution Section 2
     # ===============================================
-    x2 = conv_block_2D(x1, 3, [64, 64, 256], stage=2, block='a', strides=(1, 1), trainable=True)
-    x2 = identity_block_2D(x2, 3, [64, 64, 256], stage=2, block='b', trainable=True)
-    x2 = identity_block_2D(x2, 3, [64, 64, 256], stage=2, block='c', trainable=True)
+    x2 = conv_block_2D(x1, 3, [64, 64, 256], stage=2, block='a', strides=(1, 1), trainable=True, fold_bn=fold_bn)
+    x2 = identity_block_2D(x2, 3, [64, 64, 256], stage=2, block='b', trainable=True, fold_bn=fold_bn)
+    x2 = identity_block_2D(x2, 3, [64, 64, 256], stage=2, block='c', trainable=True, fold_bn=fold_bn)
     # ===============================================
     #            Convolution Section 3
     # ===============================================
-    x3 = conv_block_2D(x2, 3, [128, 128, 512], stage=3, block='a', trainable=True)
-    x3 = identity_block_2D(x3, 3, [128, 128, 512], stage=3, block='b', trainable=True)
-    x3 = identity_block_2D(x3, 3, [128, 128, 512], stage=3, block='c', trainable=True)
+    x3 = conv_block_2D(x2, 3, [128, 128, 512], stage=3, block='a', trainable=True, fold_bn=fold_bn)
+    x3 = identity_block_2D(x3, 3, [128, 128, 512], stage=3, block='b', trainable=True, fold_bn=fold_bn)
+    x3 = identity_block_2D(x3, 3, [128, 128, 512], stage=3, block='c', trainable=True, fold_bn=fold_bn)
     # ===============================================
     #            Convolution Section 4
     # ===============================================
-    x4 = conv_block_2D(x3, 3, [256, 256, 1024], stage=4, block='a', strides=(1, 1), trainable=True)
-    x4 = identity_block_2D(x4, 3, [256, 256, 1024], stage=4, block='b', trainable=True)
-    x4 = identity_block_2D(x4, 3, [256, 256, 1024], stage=4, block='c', trainable=True)
+    x4 = conv_block_2D(x3, 3, [256, 256, 1024], stage=4, block='a', strides=(1, 1), trainable=True, fold_bn=fold_bn)
+    x4 = identity_block_2D(x4, 3, [256, 256, 1024], stage=4, block='b', trainable=True, fold_bn=fold_bn)
+    x4 = identity_block_2D(x4, 3, [256, 256, 1024], stage=4, block='c', trainable=True, fold_bn=fold_bn)
     # ===============================================
     #            Convolution Section 5
     # ===============================================
-    x5 = conv_block_2D(x4, 3, [512, 512, 2048], stage=5, block='a', trainable=True)
-    x5 = identity_block_2D(x5, 3, [512, 512, 2048], stage=5, block='b', trainable=True)
-    x5 = identity_block_2D(x5, 3, [512, 512, 2048], stage=5, block='c', trainable=True)
+    x5 = conv_block_2D(x4, 3, [512, 512, 2048], stage=5, block='a', trainable=True, fold_bn=fold_bn)
+    x5 = identity_block_2D(x5, 3, [512, 512, 2048], stage=5, block='b', trainable=True, fold_bn=fold_bn)
+    x5 = identity_block_2D(x5, 3, [512, 512, 2048], stage=5, block='c', trainable=True, fold_bn=fold_bn)
     y = MaxPooling2D((3, 1), strides=(2, 1), name='mpool2')(x5)
     return inputs, y
 
@@ -0,0 +1,188 @@
+import os
+import json
+import numpy as np
+
+# ===============================================
+#       Sharded, append-only d-vector store.
+# ===============================================
+# A store is a directory of shards. Each shard holds
+#   embeddings.f32  : float32 rows, [total rows, dim]
+#   cluster_ids.i32 : int32 speaker id per row
+#   offsets.i64     : int64 end row of each sequence
+# Rows are written before their sequence end is appended to offsets.i64, so
+# offsets.i64 is the commit log: rows past its last entry belong to a
+# sequence that was being written when the process died, and are dropped.
+# meta.json holds the dimension, the parameters the sequences were generated
+# with, and the number of sequences committed when it was last written.
+META_FILE = 'meta.json'
+SHARD_FORMAT = 'shard_{:05d}'
+
+
+def _shard_dirs(path):
+    return sorted(os.path.join(path, d) for d in os.listdir(path) if d.startswith('shard_'))
+
+
+def _committed_sequences(path):
+    offsets_paths = [os.path.join(d, 'offsets.i64') for d in _shard_dirs(path)]
+    return sum(os.path.getsize(p) // 8 for p in offsets_paths if os.path.isfile(p))
+
+
+def _committed_rows(shard_dir):
+    offsets_path = os.path.join(shard_dir, 'offsets.i64')
+    if not os.path.isfile(offsets_path):
+        return 0
+    committed = os.path.getsize(offsets_path) // 8
+    if committed == 0:
+        return 0
+    with open(offsets_path, 'rb') as f:
+        f.seek((committed - 1) * 8)
+        return int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+
+
+class EmbeddingStoreWriter(object):
+    """Appends sequences of d-vectors to a store, one sequence at a time.
+
+    Every appended sequence is flushed to disk, so a crash loses at most the
+    sequence being written. Re-opening an existing store continues in a new
+    shard after the last one.
+
+    `params` (any JSON-serializable value) records how the sequences are
+    generated. Re-opening a store refuses to append if they differ from the
+    recorded ones, or if sequences recorded as committed are missing, since
+    either way the appended sequences would not continue the stored ones.
+    `committed` is the number of sequences in the store.
+    """
+    def __init__(self, path, dim, shard_size=1000, params=None):
+        self.path = path
+        self.dim = dim
+        self.shard_size = shard_size
+        # as read back from meta.json, so tuples compare equal to lists
+        self.params = json.loads(json.dumps(params))
+        os.makedirs(path, exist_ok=True)
+        self.committed = _committed_sequences(path)
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.isfile(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            assert meta['dim'] == dim, 'embedding dimension does not match the existing store'
+            if self.committed and meta.get('params') != self.params:
+                raise ValueError('{} was generated with {}, not {}; write to a new store'.format(
+                    path, meta.get('params'), self.params))
+            if self.committed < meta.get('sequences', 0):
+                raise ValueError('{} holds {} of the {} committed sequences; write to a new store'.format(
+                    path, self.committed, meta['sequences']))
+        self._write_meta()
+        self.shard_index = len(_shard_dirs(path))
+        self.files = None
+        self.rows = 0
+        self.sequences = 0
+
+    def _write_meta(self):
+        meta_path = os.path.join(self.path, META_FILE)
+        with open(meta_path + '.part', 'w') as f:
+            json.dump({'dim': self.dim, 'params': self.params, 'sequences': self.committed}, f)
+        os.replace(meta_path + '.part', meta_path)
+
+    def _open_shard(self):
+        shard_dir = os.path.join(self.path, SHARD_FORMAT.format(self.shard_index))
+        os.makedirs(shard_dir)
+        self.files = [open(os.path.join(shard_dir, name), 'ab')
+                      for name in ('embeddings.f32', 'cluster_ids.i32', 'offsets.i64')]
+        self.rows = 0
+        self.sequences = 0
+
+    def append(self, feats, cluster_id):
+        """Append one sequence: feats [length, dim], cluster_id [length]."""
+        feats = np.ascontiguousarray(feats, dtype=np.float32)
+        cluster_id = np.ascontiguousarray(cluster_id, dtype=np.int32)
+        assert feats.ndim == 2 and feats.shape[1] == self.dim
+        assert len(cluster_id) == len(feats)
+        if self.files is None:
+            self._open_shard()
+        embeddings_file, cluster_ids_file, offsets_file = self.files
+        embeddings_file.write(feats.tobytes())
+        cluster_ids_file.write(cluster_id.tobytes())
+        embeddings_file.flush()
+        cluster_ids_file.flush()
+        self.rows += len(feats)
+        self.sequences += 1
+        offsets_file.write(np.int64(self.rows).tobytes())
+        offsets_file.flush()
+        self.committed += 1
+        if self.sequences >= self.shard_size:
+            self._close_shard()
+
+    def _close_shard(self):
+        for f in self.files:
+            f.close()
+        self.files = None
+        self.shard_index += 1
+        # offsets.i64 stays the commit log; the count in meta.json only lags
+        # behind it, by at most the sequences of the open shard
+        self._write_meta()
+
+    def close(self):
+        if self.files is not None:
+            self._close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EmbeddingStore(object):
+    """Read-only, memory-mapped view of a store written by EmbeddingStoreWriter."""
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.dim = json.load(f)['dim']
+        self.shard_dirs = [d for d in _shard_dirs(path) if _committed_rows(d) > 0]
+
+    def __len__(self):
+        """Number of committed sequences."""
+        return sum(os.path.getsize(os.path.join(d, 'offsets.i64')) // 8 for d in self.shard_dirs)
+
+    def load_shard(self, index):
+        """Return (embeddings [rows, dim], cluster_ids [rows], offsets [sequences]).
+
+        All three are memory-mapped; nothing is read until it is accessed.
+        """
+        shard_dir = self.shard_dirs[index]
+        rows = _committed_rows(shard_dir)
+        offsets = np.memmap(os.path.join(shard_dir, 'offsets.i64'), dtype=np.int64, mode='r')
+        embeddings = np.memmap(os.path.join(shard_dir, 'embeddings.f32'), dtype=np.float32, mode='r',
+                               shape=(rows, self.dim))
+        cluster_ids = np.memmap(os.path.join(shard_dir, 'cluster_ids.i32'), dtype=np.int32, mode='r',
+                                shape=(rows,))
+        return embeddings, cluster_ids, offsets
+
+    def sequences(self):
+        """Yield (feats, cluster_id) views for every sequence in the store."""
+        for index in range(len(self.shard_dirs)):
+            embeddings, cluster_ids, offsets = self.load_shard(index)
+            begin = 0
+            for end in offsets:
+                yield embeddings[begin:end], cluster_ids[begin:end]
+                begin = end
+
+    def training_shards(self):
+        """Yield (train_sequence, train_cluster_id) per shard, for UISRNN.fit.
+
+        `train_sequence` is the memory-mapped float32 matrix of the shard.
+        Cluster ids are made unique per sequence ("<sequence>_<speaker>"),
+        as `fit()` expects for concatenated input. Calling `fit()` once per
+        shard accumulates the transition bias across shards and bounds the
+        training memory to one shard times `num_permutations`, since `fit()`
+        copies its input once per permutation.
+        """
+        sequence_base = 0
+        for index in range(len(self.shard_dirs)):
+            embeddings, cluster_ids, offsets = self.load_shard(index)
+            lengths = np.diff(np.concatenate([[0], offsets]))
+            sequence_ids = np.repeat(np.arange(sequence_base, sequence_base + len(offsets)), lengths)
+            train_cluster_id = np.char.add(np.char.add(sequence_ids.astype(str), '_'),
+                                           np.asarray(cluster_ids).astype(str))
+            sequence_base += len(offsets)
+            yield embeddings, train_cluster_id
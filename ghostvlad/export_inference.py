@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sys
+import shutil
+import numpy as np
+
+import toolkits
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools import runtimeConfig
+
+# ===========================================
+#        Parse the argument
+# ===========================================
+import argparse
+parser = argparse.ArgumentParser(description='Export the GhostVLAD eval network as a frozen, '
+                                             'inference-only SavedModel ending at the fc6 embedding.')
+parser.add_argument('--resume', default=r'pretrained/weights.h5', type=str)
+parser.add_argument('--output', default=r'pretrained/inference', type=str,
+                    help='SavedModel directory, replaced if it exists')
+# set up network configuration.
+parser.add_argument('--net', default='resnet34s', choices=['resnet34s', 'resnet34l'], type=str)
+parser.add_argument('--ghost_cluster', default=2, type=int)
+parser.add_argument('--vlad_cluster', default=8, type=int)
+parser.add_argument('--bottleneck_dim', default=512, type=int)
+parser.add_argument('--aggregation_mode', default='gvlad', choices=['avg', 'vlad', 'gvlad'], type=str)
+parser.add_argument('--loss', default='softmax', choices=['softmax', 'amsoftmax'], type=str)
+runtimeConfig.add_arguments(parser)
+# this script runs on the CPU unless --gpu is given
+parser.set_defaults(gpu='')
+
+INPUT_DIM = (257, None, 1)
+NUM_CLASS = 5994
+
+
+def fold_weights(eval_model, inference_model):
+    """Copy the eval weights into the inference model, folding BatchNorm into the convolutions.
+
+    For a convolution `conv` followed by `conv/bn` in the eval model,
+    bn(conv(x)) = conv(x) * scale + (beta - mean * scale) with
+    scale = gamma / sqrt(variance + epsilon), so the inference model's
+    convolution gets the kernel scaled per output channel and that bias.
+    """
+    source = {layer.name: layer for layer in eval_model.layers}
+    for layer in inference_model.layers:
+        if not layer.get_weights():
+            continue
+        bn = source.get(layer.name + '/bn')
+        if bn is None:
+            layer.set_weights(source[layer.name].get_weights())
+            continue
+        kernel, = source[layer.name].get_weights()
+        gamma, beta, mean, variance = bn.get_weights()
+        scale = gamma / np.sqrt(variance + bn.epsilon)
+        layer.set_weights([kernel * scale, beta - mean * scale])
+
+
+def export_saved_model(session, inference_model, export_dir):
+    """Freeze the inference model's variables into constants and save it as a SavedModel.
+
+    The signature 'serving_default' maps 'input' [batch, 257, time, 1] to
+    'embedding' [batch, bottleneck_dim].
+    """
+    import tensorflow as tf
+    graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+        session, session.graph.as_graph_def(), [inference_model.output.op.name])
+    graph_def = tf.compat.v1.graph_util.remove_training_nodes(graph_def)
+
+    tmp_dir = export_dir + '.part'
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        inputs = graph.get_tensor_by_name(inference_model.input.name)
+        outputs = graph.get_tensor_by_name(inference_model.output.name)
+        with tf.compat.v1.Session(graph=graph) as frozen_session:
+            tf.compat.v1.saved_model.simple_save(frozen_session, tmp_dir,
+                                                 inputs={'input': inputs},
+                                                 outputs={'embedding': outputs})
+    if os.path.isdir(export_dir):
+        shutil.rmtree(export_dir)
+    os.replace(tmp_dir, export_dir)
+
+
+def check_export(eval_model, export_dir, spec_len=250, batch_size=4):
+    """Compare the exported embeddings with the eval model on random input."""
+    import tensorflow as tf
+    batch = np.random.RandomState(0).normal(size=(batch_size, INPUT_DIM[0], spec_len, 1)).astype(np.float32)
+    expected = eval_model.predict(batch)
+    with tf.Graph().as_default() as graph, tf.compat.v1.Session(graph=graph) as session:
+        meta_graph = tf.compat.v1.saved_model.loader.load(session, [tf.compat.v1.saved_model.tag_constants.SERVING],
+                                                          export_dir)
+        signature = meta_graph.signature_def['serving_default']
+        got = session.run(signature.outputs['embedding'].name, {signature.inputs['input'].name: batch})
+    cosine = np.sum(expected * got, axis=1) / (np.linalg.norm(expected, axis=1) * np.linalg.norm(got, axis=1))
+    print('==> max abs difference {:.2e}, min cosine similarity {:.6f}'.format(np.abs(expected - got).max(),
+                                                                              cosine.min()))
+
+
+def main(args):
+    runtimeConfig.configure_from_args(args)
+    session = toolkits.initialize_GPU()
+    import keras
+    keras.backend.set_learning_phase(0)
+    import model
+
+    network_eval = model.vggvox_resnet2d_icassp(input_dim=INPUT_DIM, num_class=NUM_CLASS, mode='eval', args=args)
+    if not os.path.isfile(args.resume):
+        raise IOError("==> no checkpoint found at '{}'".format(args.resume))
+    network_eval.load_weights(args.resume, by_name=True)
+    print('==> successfully loading model {}.'.format(args.resume))
+
+    network_inference = model.vggvox_resnet2d_icassp(input_dim=INPUT_DIM, num_class=NUM_CLASS, mode='inference',
+                                                     args=args)
+    fold_weights(network_eval, network_inference)
+    export_saved_model(session, network_inference, args.output)
+    print('==> exported inference model to {}.'.format(args.output))
+    check_export(network_eval, args.output)
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
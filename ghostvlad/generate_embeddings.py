@@ -2,11 +2,18 @@ from __future__ import absolute_import
 from __future__ import print_function
 import os
 import sys
+import itertools
+import functools
+import collections
 import numpy as np
 import librosa
 
 import toolkits
-import random
+from embedding_store import EmbeddingStoreWriter
+from utterance_pack import UtterancePack, build_pack
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools import runtimeConfig
 
 # ===========================================
 #        Parse the argument
@@ -14,7 +21,6 @@ import random
 import argparse
 parser = argparse.ArgumentParser()
 # set up training configuration.
-parser.add_argument('--gpu', default='', type=str)
 parser.add_argument('--resume', default=r'pretrained/weights.h5', type=str)
 parser.add_argument('--data_path', default='4persons', type=str)
 # set up network configuration.
@@ -26,6 +32,32 @@ parser.add_argument('--aggregation_mode', default='gvlad', choices=['avg', 'vlad
 # set up learning rate, training loss and optimizer.
 parser.add_argument('--loss', default='softmax', choices=['softmax', 'amsoftmax'], type=str)
 parser.add_argument('--test_type', default='normal', choices=['normal', 'hard', 'extend'], type=str)
+# set up output.
+parser.add_argument('--output', default='training_data', type=str,
+                    help='embedding store directory, resumed if it exists and was generated with the same '
+                         'seed, sources and model')
+parser.add_argument('--shard_size', default=1000, type=int,
+                    help='number of sequences per embedding store shard')
+parser.add_argument('--epochs', default=7000, type=int,
+                    help='number of merged utterances to generate')
+parser.add_argument('--seed', default=0, type=int,
+                    help='base random seed; epoch i always uses seed (seed, i)')
+# set up data pipeline.
+parser.add_argument('--workers', default=os.cpu_count(), type=int,
+                    help='processes for decoding, VAD and STFT')
+parser.add_argument('--max_pending', default=16, type=int,
+                    help='maximum number of prepared epochs waiting for the model, '
+                         'on top of the --workers epochs being prepared')
+parser.add_argument('--batch_size', default=32, type=int,
+                    help='number of windows per predict call')
+parser.add_argument('--pack_dir', default='', type=str,
+                    help='directory of a pack of decoded, VAD-trimmed source files, built on the first run '
+                         '(4 bytes per sample of the whole dataset) so later draws skip decoding; '
+                         'disabled by default, files are then decoded on every draw')
+# set up threads and CPU/GPU placement.
+runtimeConfig.add_arguments(parser)
+# this script runs on the CPU unless --gpu is given
+parser.set_defaults(gpu='')
 
 global args
 args = parser.parse_args()
@@ -52,30 +84,29 @@ def load_wav(vid_path, sr):
     assert sr_ret == sr
 
     intervals = librosa.effects.split(wav, top_db=20)
-    wav_output = []
-    for sliced in intervals:
-      wav_output.extend(wav[sliced[0]:sliced[1]])
-    wav_output = np.array(wav_output)
-    return wav_output
+    if len(intervals) == 0:
+        return wav[:0]
+    return np.concatenate([wav[start:end] for start, end in intervals])
 
 def lin_spectogram_from_wav(wav, hop_length, win_length, n_fft=1024):
     linear = librosa.stft(wav, n_fft=n_fft, win_length=win_length, hop_length=hop_length) # linear spectrogram
     return linear.T
 
-def load_data(path_spk_tuples, win_length=400, sr=16000, hop_length=160, n_fft=512, min_win_time=240, max_win_time=1600):
-    win_time = np.random.randint(min_win_time, max_win_time, 1)[0] # win_length in [240,1600] ms
+def load_data(path_spk_tuples, win_length=400, sr=16000, hop_length=160, n_fft=512, min_win_time=240, max_win_time=1600,
+              rng=np.random, pack=None):
+    win_time = rng.randint(min_win_time, max_win_time, 1)[0] # win_length in [240,1600] ms
     win_spec = win_time//(1000//(sr//hop_length)) # win_length in spectrum
     hop_spec = win_spec//2
 
-    wavs = np.array([])
-    change_points = []
     paths = list(zip(*path_spk_tuples))[0]
     speakers = list(zip(*path_spk_tuples))[1]
 
-    for path in paths:
-        wav = load_wav(path, sr=sr) # VAD
-        wavs = np.concatenate((wavs, wav))
-        change_points.append(wavs.shape[0]//hop_length) # change_point in spectrum
+    if pack is None:
+        wavs = [load_wav(path, sr=sr) for path in paths] # VAD
+    else:
+        wavs = [pack[path] for path in paths] # VAD-trimmed views into the utterance pack
+    change_points = np.cumsum([len(wav) for wav in wavs]) // hop_length # change_point in spectrum
+    wavs = np.concatenate(wavs).astype(float)
 
     linear_spect = lin_spectogram_from_wav(wavs, hop_length, win_length, n_fft)
     mag, _ = librosa.magphase(linear_spect)  # magnitude
@@ -128,18 +159,76 @@ def prepare_data(SRC_PATH):
     path_spk_list = list(zip(allpath_list, allspk_list))
     return path_spk_list
 
+# ===============================================
+#       parallel data pipeline.
+# ===============================================
+def init_worker(path_spk_tuples, pack_dir):
+    global worker_path_spk_tuples, worker_pack
+    worker_path_spk_tuples = path_spk_tuples
+    worker_pack = UtterancePack(pack_dir) if pack_dir else None
+
+def make_sequence(epoch, seed):
+    """Sample, decode and window the merged utterance of one epoch. Runs in a pool worker.
+
+    All randomness comes from a generator seeded with (seed, epoch), so the
+    sequence of an epoch does not depend on the worker count or scheduling.
+    """
+    rng = np.random.RandomState([seed, epoch])
+    # A merged utterance contains [10,20] utterances
+    splits_count = rng.randint(10, 20)
+    picks = rng.choice(len(worker_path_spk_tuples), splits_count, replace=False)
+    path_spks = [worker_path_spk_tuples[i] for i in picks]
+    utterance_specs, utterance_speakers = load_data(path_spks, min_win_time=500, max_win_time=1600, rng=rng,
+                                                    pack=worker_pack)
+    # every window of an epoch has the same width, so they stack into one batch
+    return np.array(utterance_specs, dtype=np.float32), utterance_speakers, len(path_spks)
+
 def main():
+    # before any pool starts, so workers inherit the affinity and thread limits
+    runtimeConfig.configure_from_args(args)
+
+    # ==================================
+    #       Start the data pipeline.
+    # ==================================
+    SRC_PATH = r'/data/dataset/SpkWav120'
+    path_spk_tuples = prepare_data(SRC_PATH)
+    if args.pack_dir:
+        # the pool of source files is small and drawn from over and over,
+        # so decode and VAD each file once
+        paths = [path for path, _ in path_spk_tuples]
+        pack = build_pack(args.pack_dir, paths, functools.partial(load_wav, sr=16000),
+                          make_pool=functools.partial(runtimeConfig.spawn_pool, args.workers))
+        print('==> utterance pack {} holds {} files.'.format(args.pack_dir, len(pack)))
+
+    # epochs already in the store are skipped; since every epoch has its own
+    # seed, a resumed run produces the same store as an uninterrupted one.
+    # The store refuses to resume if it was generated with other parameters.
+    params = {'seed': args.seed,
+              'sources': [SRC_PATH, len(path_spk_tuples)],
+              'weights': os.path.abspath(args.resume),
+              'model': [args.net, args.ghost_cluster, args.vlad_cluster, args.bottleneck_dim,
+                        args.aggregation_mode, args.loss]}
+    store = EmbeddingStoreWriter(args.output, dim=args.bottleneck_dim, shard_size=args.shard_size, params=params)
+    start_epoch = store.committed
+    epochs = iter(range(start_epoch, args.epochs))
+    pending = collections.deque()
+
+    pool = runtimeConfig.spawn_pool(args.workers, initializer=init_worker,
+                                    initargs=(path_spk_tuples, args.pack_dir))
+
+    def fill(count):
+        for epoch in itertools.islice(epochs, count):
+            pending.append((epoch, pool.submit(make_sequence, epoch, args.seed)))
+
+    # workers start decoding while the model is being built; in flight are
+    # the epochs being prepared plus up to max_pending prepared ones waiting
+    # for the model, so every worker stays busy
+    fill((args.workers or os.cpu_count()) + args.max_pending)
 
     # gpu configuration
-    toolkits.initialize_GPU(args)
+    toolkits.initialize_GPU()
 
     import model
-    # ==================================
-    #       Get Train/Val.
-    # ==================================
-    
-    total_list = [os.path.join(args.data_path, file) for file in os.listdir(args.data_path)]
-    unique_list = np.unique(total_list)
 
     # ==================================
     #       Get Model
@@ -171,31 +260,20 @@ def main():
     else:
         raise IOError('==> please type in the model to load')
 
-    # The feature extraction process has to be done sample-by-sample,
-    # because each sample is of different lengths.
-
-    SRC_PATH = r'/data/dataset/SpkWav120'
-    path_spk_tuples = prepare_data(SRC_PATH)
-    train_sequence = []
-    train_cluster_id = []
-
-    for epoch in range(7000): # Random choice utterances from whole wavfiles
-        # A merged utterance contains [10,20] utterances
-        splits_count = np.random.randint(10, 20, 1)
-        path_spks = random.sample(path_spk_tuples, splits_count[0])
-        utterance_specs, utterance_speakers = load_data(path_spks, min_win_time=500, max_win_time=1600)
-        feats = []
-        for spec in utterance_specs:
-            spec = np.expand_dims(np.expand_dims(spec, 0), -1)
-            v = network_eval.predict(spec)
-            feats += [v]
-
-        feats = np.array(feats)[:,0,:]  # [splits, embedding dim]
-        train_sequence.append(feats)
-        train_cluster_id.append(utterance_speakers)
-        print("epoch:{}, utterance length: {}, speakers: {}".format(epoch, len(utterance_speakers), len(path_spks)))
-
-    np.savez('training_data', train_sequence=train_sequence, train_cluster_id=train_cluster_id)
+    # every sequence is flushed to the store as soon as it is computed,
+    # so an interrupted run keeps all completed epochs.
+    with pool, store:
+        while pending:
+            # consume in submission order, so the store does not depend on timing
+            epoch, future = pending.popleft()
+            utterance_specs, utterance_speakers, splits_count = future.result()
+            fill(1)
+            if len(utterance_specs):
+                feats = network_eval.predict(np.expand_dims(utterance_specs, -1), batch_size=args.batch_size)
+            else:
+                feats = np.zeros((0, args.bottleneck_dim))
+            store.append(feats, utterance_speakers)  # [splits, embedding dim]
+            print("epoch:{}, utterance length: {}, speakers: {}".format(epoch, len(utterance_speakers), splits_count))
 
 
 if __name__ == "__main__":
@@ -78,6 +78,11 @@ def amsoftmax_loss(y_true, y_pred, scale=30, margin=0.35):
 
 
 def vggvox_resnet2d_icassp(input_dim=(257, 250, 1), num_class=8631, mode='train', args=None):
+    '''
+    mode: 'train', 'eval', or 'inference'. 'inference' builds the eval network up to
+    the L2-normalized fc6 embedding only, with BatchNorm folded into the convolutions;
+    its weights come from export_inference.fold_weights().
+    '''
     net=args.net
     loss=args.loss
     vlad_clusters=args.vlad_cluster
@@ -86,9 +91,9 @@ def vggvox_resnet2d_icassp(input_dim=(257, 250, 1), num_class=8631, mode='train'
     aggregation = args.aggregation_mode
 
     if net == 'resnet34s':
-        inputs, x = backbone.resnet_2D_v1(input_dim=input_dim, mode=mode)
+        inputs, x = backbone.resnet_2D_v1(input_dim=input_dim, mode=mode, fold_bn=(mode == 'inference'))
     else:
-        inputs, x = backbone.resnet_2D_v2(input_dim=input_dim, mode=mode)
+        inputs, x = backbone.resnet_2D_v2(input_dim=input_dim, mode=mode, fold_bn=(mode == 'inference'))
     # ===============================================
     #            Fully Connected Block 1
     # ===============================================
@@ -145,6 +150,11 @@ def vggvox_resnet2d_icassp(input_dim=(257, 250, 1), num_class=8631, mode='train'
                            bias_regularizer=keras.regularizers.l2(weight_decay),
                            name='fc6')(x)
 
+    if mode == 'inference':
+        # embedding only, no classifier
+        y = keras.layers.Lambda(lambda x: keras.backend.l2_normalize(x, 1), name='embedding')(x)
+        return keras.models.Model(inputs, y, name='vggvox_resnet2D_{}_inference'.format(aggregation))
+
     # ===============================================
     #            Softmax Vs AMSoftmax
     # ===============================================
@@ -8,6 +8,9 @@ import librosa
 import toolkits
 import utils as ut
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tools import runtimeConfig
+
 import pdb
 # ===========================================
 #        Parse the argument
@@ -15,7 +18,6 @@ import pdb
 import argparse
 parser = argparse.ArgumentParser()
 # set up training configuration.
-parser.add_argument('--gpu', default='', type=str)
 parser.add_argument('--resume', default=r'pretrained/weights.h5', type=str)
 parser.add_argument('--data_path', default='4persons', type=str)
 # set up network configuration.
@@ -27,6 +29,9 @@ parser.add_argument('--aggregation_mode', default='gvlad', choices=['avg', 'vlad
 # set up learning rate, training loss and optimizer.
 parser.add_argument('--loss', default='softmax', choices=['softmax', 'amsoftmax'], type=str)
 parser.add_argument('--test_type', default='normal', choices=['normal', 'hard', 'extend'], type=str)
+runtimeConfig.add_arguments(parser)
+# this script runs on the CPU unless --gpu is given
+parser.set_defaults(gpu='')
 
 global args
 args = parser.parse_args()
@@ -100,7 +105,8 @@ def load_data(path, split=False, win_length=400, sr=16000, hop_length=160, n_fft
 def main():
 
     # gpu configuration
-    toolkits.initialize_GPU(args)
+    runtimeConfig.configure_from_args(args)
+    toolkits.initialize_GPU()
 
     import model
     # ==================================
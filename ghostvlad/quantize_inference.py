@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import numpy as np
+import librosa
+
+# ===========================================
+#        Parse the argument
+# ===========================================
+import argparse
+parser = argparse.ArgumentParser(description='Convert the exported GhostVLAD inference model to a quantized '
+                                             'TFLite model.')
+parser.add_argument('--export_dir', default=r'pretrained/inference', type=str,
+                    help='SavedModel written by export_inference.py')
+parser.add_argument('--mode', default='dynamic', choices=['dynamic', 'float16', 'int8'], type=str,
+                    help='dynamic: int8 weights, float activations; float16: float16 weights; '
+                         'int8: int8 weights and activations, calibrated on --calibration_wavs')
+parser.add_argument('--output', default='', type=str,
+                    help='.tflite file, pretrained/inference_<mode>.tflite when empty')
+parser.add_argument('--spec_len', default=100, type=int,
+                    help='window width in frames the model is converted for; '
+                         '100 matches one embedding per second at a 160 hop')
+parser.add_argument('--calibration_wavs', nargs='*', default=[],
+                    help='audio files whose spectrogram windows calibrate the int8 activation ranges')
+parser.add_argument('--calibration_windows', default=200, type=int,
+                    help='number of windows drawn from --calibration_wavs')
+
+
+def calibration_windows(wav_paths, spec_len=100, num_windows=200, sr=16000, win_length=400, hop_length=160,
+                        n_fft=512):
+    """Random normalized magnitude windows [num_windows, 257, spec_len, 1], as fed to the network."""
+    windows = []
+    for path in wav_paths:
+        wav, _ = librosa.load(path, sr=sr)
+        linear = librosa.stft(wav, n_fft=n_fft, win_length=win_length, hop_length=hop_length)
+        mag, _ = librosa.magphase(linear)
+        # preprocessing, subtract mean, divided by time-wise var
+        mag = (mag - mag.mean(0, keepdims=True)) / (mag.std(0, keepdims=True) + 1e-5)
+        for start in range(0, mag.shape[1] - spec_len + 1, spec_len // 2):
+            windows.append(mag[:, start:start + spec_len])
+    if not windows:
+        raise ValueError('==> no calibration window of {} frames in {}'.format(spec_len, wav_paths))
+    picks = np.random.RandomState(0).permutation(len(windows))[:num_windows]
+    return np.array(windows, dtype=np.float32)[picks, :, :, None]
+
+
+def convert(export_dir, output_path, mode='dynamic', spec_len=100, representative_windows=None):
+    """Convert the exported SavedModel to a TFLite model quantized according to `mode`.
+
+    TFLite needs a static input shape, so the model is converted for windows
+    of `spec_len` frames; the batch dimension is resized at run time.
+    """
+    import tensorflow as tf
+    with tf.Graph().as_default() as graph, tf.compat.v1.Session(graph=graph) as session:
+        meta_graph = tf.compat.v1.saved_model.loader.load(session, [tf.compat.v1.saved_model.tag_constants.SERVING],
+                                                          export_dir)
+        input_name = meta_graph.signature_def['serving_default'].inputs['input'].name.split(':')[0]
+
+    converter = tf.compat.v1.lite.TFLiteConverter.from_saved_model(export_dir,
+                                                                   input_shapes={input_name: [1, 257, spec_len, 1]})
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == 'int8':
+        if representative_windows is None:
+            raise ValueError('==> int8 mode needs representative windows for calibration')
+
+        def representative_dataset():
+            for window in representative_windows:
+                yield [window[None]]
+        converter.representative_dataset = representative_dataset
+    tflite_model = converter.convert()
+
+    tmp_path = output_path + '.part'
+    with open(tmp_path, 'wb') as f:
+        f.write(tflite_model)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def main(args):
+    output = args.output or os.path.join(os.path.dirname(args.export_dir.rstrip('/')),
+                                         'inference_{}.tflite'.format(args.mode))
+    representative = None
+    if args.mode == 'int8':
+        representative = calibration_windows(args.calibration_wavs, args.spec_len, args.calibration_windows)
+    convert(args.export_dir, output, args.mode, args.spec_len, representative)
+    print('==> wrote {} ({:.1f} MB).'.format(output, os.path.getsize(output) / 2**20))
+
+
+if __name__ == "__main__":
+    main(parser.parse_args())
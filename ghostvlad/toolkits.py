@@ -1,13 +1,19 @@
 import os
+import sys
 import numpy as np
 
-def initialize_GPU(args):
-    # Initialize GPUs
+def initialize_GPU():
+    # Initialize GPUs with the device and thread settings applied by
+    # runtimeConfig.configure_from_args(), which the caller runs first
     import tensorflow as tf
-    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
-    config = tf.ConfigProto()
-    config.gpu_options.allow_growth = True
-    session = tf.Session(config=config)
+    import keras.backend as K
+    # tools/ lives in the repository root, one level above this file
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    if root not in sys.path:
+        sys.path.append(root)
+    from tools import runtimeConfig
+    session = tf.Session(config=runtimeConfig.tensorflow_config())
+    K.set_session(session)
     return session
 
 def get_chunks(l, n):
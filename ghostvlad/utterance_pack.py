@@ -0,0 +1,94 @@
+import os
+import json
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# ===============================================
+#       Pack of decoded, VAD-trimmed utterances.
+# ===============================================
+# A pack is a directory holding
+#   samples.f32 : float32 samples of every utterance, back to back
+#   offsets.i64 : int64 end sample of each utterance
+#   meta.json   : sample rate, source paths and their (size, mtime) stamps
+# meta.json is written last, so a pack without it is incomplete and rebuilt.
+META_FILE = 'meta.json'
+
+
+def _stamps(paths):
+    return [[os.path.getsize(path), os.path.getmtime(path)] for path in paths]
+
+
+def _is_current(pack_dir, paths, sample_rate):
+    meta_path = os.path.join(pack_dir, META_FILE)
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return (meta['sample_rate'] == sample_rate and meta['paths'] == list(paths) and
+            meta['stamps'] == _stamps(paths))
+
+
+def build_pack(pack_dir, paths, decode, sample_rate=16000, make_pool=ProcessPoolExecutor):
+    """Decode every path once into a pack, unless an up-to-date pack exists.
+
+    Args:
+        pack_dir: directory of the pack.
+        paths: list of audio paths, in the order they are stored.
+        decode: picklable function mapping a path to a 1-d float array at
+            `sample_rate`, e.g. `functools.partial(load_wav, sr=16000)`.
+        make_pool: function returning the executor used for decoding, e.g.
+            `functools.partial(runtimeConfig.spawn_pool, workers)`; only
+            called when the pack is rebuilt.
+
+    Returns:
+        UtterancePack of the pack.
+    """
+    paths = list(paths)
+    if not _is_current(pack_dir, paths, sample_rate):
+        os.makedirs(pack_dir, exist_ok=True)
+        meta_path = os.path.join(pack_dir, META_FILE)
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+        offsets = np.zeros(len(paths), dtype=np.int64)
+        end = 0
+        with make_pool() as pool, \
+                open(os.path.join(pack_dir, 'samples.f32'), 'wb') as f:
+            for i, wav in enumerate(pool.map(decode, paths, chunksize=8)):
+                f.write(np.ascontiguousarray(wav, dtype=np.float32).tobytes())
+                end += len(wav)
+                offsets[i] = end
+        offsets.tofile(os.path.join(pack_dir, 'offsets.i64'))
+        with open(meta_path + '.part', 'w') as f:
+            json.dump({'sample_rate': sample_rate, 'paths': paths, 'stamps': _stamps(paths)}, f)
+        os.replace(meta_path + '.part', meta_path)
+    return UtterancePack(pack_dir)
+
+
+class UtterancePack(object):
+    """Read-only, memory-mapped view of a pack built by `build_pack()`.
+
+    `pack[path]` returns the utterance as a float32 view into the pack file,
+    without copying or decoding.
+    """
+    def __init__(self, pack_dir):
+        with open(os.path.join(pack_dir, META_FILE)) as f:
+            meta = json.load(f)
+        self.sample_rate = meta['sample_rate']
+        self.paths = meta['paths']
+        self.index = {path: i for i, path in enumerate(self.paths)}
+        self.ends = np.fromfile(os.path.join(pack_dir, 'offsets.i64'), dtype=np.int64)
+        self.begins = np.concatenate([[0], self.ends[:-1]])
+        if self.ends[-1:].sum() > 0:
+            self.samples = np.memmap(os.path.join(pack_dir, 'samples.f32'), dtype=np.float32, mode='r')
+        else:
+            self.samples = np.zeros(0, dtype=np.float32)  # np.memmap refuses empty files
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def __getitem__(self, path):
+        i = self.index[path]
+        return self.samples[self.begins[i]:self.ends[i]]
@@ -0,0 +1,127 @@
+import os
+import sys
+import argparse
+import socket
+import webrtcvad
+import diarization
+from tools import wavSplit, runtimeConfig
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+class StreamingDiarizer:
+    """Online diarization of 16-bit mono PCM arriving in chunks.
+
+    Voiced segments from webrtcvad are grouped into blocks of at least
+    `min_block_sec` of speech; each block is embedded with GhostVLAD and
+    appended to the UIS-RNN beam search, then its segments are emitted with
+    speaker labels. Only the current block of audio is kept in memory.
+    """
+    def __init__(self, diarizer, num_speakers=0, sample_rate=16000, aggressiveness=3,
+                 frame_duration_ms=30, padding_duration_ms=300, max_segment_ms=3000,
+                 min_block_sec=2.0, win_len=400, hop_len=160, embedding_per_sec=1.0, overlap_rate=0.4):
+        self.diarizer = diarizer
+        self.num_speakers = num_speakers
+        self.sample_rate = sample_rate
+        self.vad = webrtcvad.Vad(int(aggressiveness))
+        self.frame_duration_ms = frame_duration_ms
+        self.padding_duration_ms = padding_duration_ms
+        self.max_segment_ms = max_segment_ms
+        self.min_block_sec = min_block_sec
+        self.win_len = win_len
+        self.hop_len = hop_len
+        self.embedding_per_sec = embedding_per_sec
+        self.overlap_rate = overlap_rate
+        self.beam_set = None
+        self.pending = []
+        self.last_speaker = None
+
+    def process(self, chunks):
+        """Consume an iterable of PCM byte chunks and yield labelled segments."""
+        frames = wavSplit.stream_frame_generator(self.frame_duration_ms, chunks, self.sample_rate)
+        segments = wavSplit.vad_collector(self.sample_rate, self.frame_duration_ms,
+                                          self.padding_duration_ms, self.vad, frames,
+                                          max_segment_ms=self.max_segment_ms)
+        for segment in segments:
+            self.pending.append(segment)
+            if sum(seg.end - seg.begin for seg in self.pending) >= self.min_block_sec:
+                yield from self.flush()
+        yield from self.flush(final=True)
+
+    def flush(self, final=False):
+        """Diarize the pending block and return its labelled segments.
+
+        Only whole utterance windows are embedded, so the segments at the end
+        of a block that no window reached are kept pending and diarized with
+        the next block. At the end of the stream they take the speaker of the
+        last labelled segment instead; segments are never returned without a
+        speaker.
+        """
+        segments, self.pending = self.pending, []
+        if not segments:
+            return []
+        utterances_spec = diarization.prepare_ghostvlad_data(segments, self.sample_rate, self.win_len, self.hop_len,
+                                                             self.embedding_per_sec, self.overlap_rate)
+        feats = self.diarizer.embed(utterances_spec)
+        labels, self.beam_set = self.diarizer.cluster_online(feats, self.num_speakers, self.beam_set)
+        diarization.assign_speakers(segments, labels, self.embedding_per_sec, self.overlap_rate)
+
+        num_labelled = len(segments)
+        while num_labelled and segments[num_labelled - 1].speaker == diarization.NO_SPEAKER:
+            num_labelled -= 1
+        if not final:
+            segments, self.pending = segments[:num_labelled], segments[num_labelled:]
+        for segment in segments:
+            if segment.speaker == diarization.NO_SPEAKER:
+                segment.speaker = self.last_speaker
+            else:
+                self.last_speaker = segment.speaker
+        return [segment for segment in segments if segment.speaker is not None]
+
+
+def read_chunks(stream, chunk_size=4096):
+    return iter(lambda: stream.read(chunk_size), b'')
+
+def main(args):
+    runtimeConfig.configure_from_args(args)
+    diarizer = diarization.Diarizer(batch_size=args.batch_size, uisrnn_device=args.device,
+                                    ghostvlad_tflite_path=args.ghostvlad_tflite)
+    streamer = StreamingDiarizer(diarizer,
+                                 num_speakers=args.num_speakers,
+                                 sample_rate=args.sample_rate,
+                                 padding_duration_ms=args.pad_silence_ms,
+                                 max_segment_ms=args.max_segment_ms,
+                                 min_block_sec=args.min_block_sec)
+    if args.port:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((args.host, args.port))
+        server.listen(1)
+        print(f'[INFO] Waiting for PCM stream on {args.host}:{args.port}', file=sys.stderr)
+        connection, _ = server.accept()
+        stream = connection.makefile('rb')
+    else:
+        stream = sys.stdin.buffer
+
+    for segment in streamer.process(read_chunks(stream)):
+        print(f'{segment.begin:.2f}\t{segment.end:.2f}\tSpeaker {segment.speaker}', flush=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Diarize raw 16-bit mono PCM read from stdin or a TCP socket.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0,
+                        help='listen for one PCM connection on this port, read stdin when 0')
+    parser.add_argument('--sample_rate', type=int, default=16000, choices=[8000, 16000, 32000])
+    parser.add_argument('--num_speakers', type=int, default=10,
+                        help='manual speaker limit')
+    parser.add_argument('--pad_silence_ms', type=int, default=300,
+                        help='pad silence duration in millisecond for each segment during voice activity detection')
+    parser.add_argument('--max_segment_ms', type=int, default=3000,
+                        help='emit a voiced segment once it reaches this duration')
+    parser.add_argument('--min_block_sec', type=float, default=2.0,
+                        help='seconds of speech collected before each embedding/clustering update')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='number of utterance windows per ghostvlad predict call')
+    parser.add_argument('--ghostvlad_tflite', type=str, default='',
+                        help='quantized GhostVLAD from ghostvlad/quantize_inference.py to embed with')
+    runtimeConfig.add_arguments(parser)
+    args = parser.parse_args()
+    main(args)
@@ -1,2 +1,5 @@
 from . import wavSplit
-from . import wavTranscriber
\ No newline at end of file
+from . import wavTranscriber
+from . import featureCache
+from . import featureFrontend
+from . import runtimeConfig
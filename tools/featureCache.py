@@ -0,0 +1,52 @@
+import os
+import json
+import hashlib
+import numpy as np
+from . import wavSplit
+
+class FeatureCache(object):
+    """On-disk cache of the intermediate arrays of one audio file.
+
+    Arrays are stored as .npy files under `<cache_dir>/<audio hash>/`, named
+    after the pipeline stage and a hash of every parameter that affects it,
+    and are loaded memory-mapped. Each stage adds its own parameters with
+    `add_params()`, so the key of a later stage also covers every earlier
+    stage it depends on: changing only clustering or output options reuses
+    all of them, changing e.g. `pad_silence_ms` recomputes everything.
+    """
+    def __init__(self, cache_dir, audio_path, **params):
+        self.cache_dir = cache_dir
+        self.audio_path = audio_path
+        self.params = dict(params)
+        self._audio_hash = None
+
+    @property
+    def audio_hash(self):
+        if self._audio_hash is None:
+            self._audio_hash = wavSplit.file_hash(self.audio_path)
+        return self._audio_hash
+
+    def add_params(self, **params):
+        """Record parameters of a stage that later stages depend on."""
+        self.params.update(params)
+
+    def path(self, stage, **params):
+        key = json.dumps(dict(self.params, **params), sort_keys=True)
+        key_hash = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, self.audio_hash, '{}-{}.npy'.format(stage, key_hash))
+
+    def load(self, stage, **params):
+        """Return the cached array memory-mapped, or None if missing."""
+        path = self.path(stage, **params)
+        if not os.path.isfile(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def save(self, stage, array, **params):
+        path = self.path(stage, **params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.part'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+        return array
@@ -0,0 +1,88 @@
+import copy
+import webrtcvad
+import numpy as np
+from . import wavSplit
+
+class FeatureFrontend(object):
+    """Per-recording analysis shared by VAD segmentation and the silence check.
+
+    The recording is framed once and the webrtcvad decision of every frame
+    is kept, with a running count of voiced frames, so the voiced duration
+    of any sample range is two index lookups instead of another VAD pass.
+    Decisions are computed on first use and, with a `featureCache.FeatureCache`,
+    stored with the other features of the recording.
+    """
+    def __init__(self, audio, sample_rate, aggressiveness=3, frame_duration_ms=30, feature_cache=None,
+                 speech_flags=None):
+        self.audio = audio
+        self.sample_rate = sample_rate
+        self.aggressiveness = int(aggressiveness)
+        self.frame_duration_ms = frame_duration_ms
+        self.frame_samples = int(sample_rate * frame_duration_ms / 1000.0)
+        self.duration = len(wavSplit.byte_view(audio)) / 2.0 / sample_rate
+        self.feature_cache = None
+        if feature_cache is not None:
+            # key the frame decisions by the parameters known now, not by
+            # those later stages add to the shared cache
+            self.feature_cache = copy.copy(feature_cache)
+            self.feature_cache.params = dict(feature_cache.params)
+        self._speech_flags = None
+        self._voiced_counts = None
+        if speech_flags is not None:
+            self._set_flags(speech_flags)
+
+    @classmethod
+    def from_file(cls, wav_path, aggressiveness=3, frame_duration_ms=30, cache_dir=wavSplit.NORMALIZED_AUDIO_DIR,
+                  feature_cache=None):
+        """Memory-map `wav_path`, normalized to 16 kHz mono PCM16 first if needed."""
+        wav_path = wavSplit.format_wave(wav_path, cache_dir)
+        audio, sample_rate, _ = wavSplit.map_wave(wav_path)
+        return cls(audio, sample_rate, aggressiveness, frame_duration_ms, feature_cache)
+
+    def _set_flags(self, flags):
+        self._speech_flags = np.asarray(flags, dtype=bool)
+        self._voiced_counts = np.concatenate([[0], np.cumsum(self._speech_flags)])
+
+    def frames(self):
+        return wavSplit.frame_generator(self.frame_duration_ms, self.audio, self.sample_rate)
+
+    @property
+    def speech_flags(self):
+        """Boolean webrtcvad decision of each frame."""
+        if self._speech_flags is None:
+            params = {'aggressiveness': self.aggressiveness, 'frame_duration_ms': self.frame_duration_ms}
+            flags = None
+            if self.feature_cache is not None:
+                flags = self.feature_cache.load('vad_frames', **params)
+            if flags is None:
+                vad = webrtcvad.Vad(self.aggressiveness)
+                flags = np.array([vad.is_speech(frame.bytes, self.sample_rate) for frame in self.frames()],
+                                 dtype=bool)
+                if self.feature_cache is not None:
+                    self.feature_cache.save('vad_frames', flags, **params)
+            self._set_flags(flags)
+        return self._speech_flags
+
+    def segments(self, padding_duration_ms=300, max_segment_ms=None):
+        """Voiced segments of the recording, from the cached frame decisions."""
+        return list(wavSplit.vad_collector(self.sample_rate, self.frame_duration_ms, padding_duration_ms, None,
+                                           self.frames(), max_segment_ms=max_segment_ms, audio=self.audio,
+                                           speech_flags=self.speech_flags))
+
+    def voiced_frames(self, ranges):
+        """Number of voiced frames inside the (start_sample, end_sample) ranges."""
+        # computes the flags, and with them the running counts, on first use
+        num_frames = len(self.speech_flags)
+        ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+        # only frames lying entirely inside a range count
+        first = np.minimum(-(-ranges[:, 0] // self.frame_samples), num_frames)
+        last = np.minimum(ranges[:, 1] // self.frame_samples, num_frames)
+        return int(np.maximum(self._voiced_counts[last] - self._voiced_counts[first], 0).sum())
+
+    def voiced_duration(self, ranges):
+        """Seconds of voiced frames inside the (start_sample, end_sample) ranges."""
+        return self.voiced_frames(ranges) * self.frame_samples / float(self.sample_rate)
+
+    def is_silent(self, ranges, silence_thresh=1):
+        """True when the ranges hold less than `silence_thresh` seconds of voiced frames."""
+        return self.voiced_duration(ranges) < silence_thresh
@@ -0,0 +1,111 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Settings applied by configure(); TensorFlow sessions created afterwards
+# read them through tensorflow_config().
+SETTINGS = {'intra_op_threads': 0, 'inter_op_threads': 0, 'allow_growth': True}
+
+# thread pools of OpenMP/BLAS libraries, read when they start, and inherited
+# by worker processes
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+def parse_cpu_list(cpus):
+    """Parse a CPU list such as '0-3,6' into a set of CPU ids."""
+    cpu_set = set()
+    for part in cpus.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpu_set.update(range(int(first), int(last) + 1))
+        else:
+            cpu_set.add(int(part))
+    return cpu_set
+
+def set_cpu_affinity(cpus):
+    """Pin this process, and the threads and processes it starts later, to `cpus`."""
+    if not hasattr(os, 'sched_setaffinity'):
+        print('[WARNING] CPU affinity is not supported on this platform, ignoring "{}"'.format(cpus))
+        return
+    os.sched_setaffinity(0, parse_cpu_list(cpus))
+
+def configure(intra_op_threads=0, inter_op_threads=0, torch_threads=0, cpu_affinity='', gpu=None,
+              allow_growth=True):
+    """Set the thread pools and CPU/GPU placement of this process.
+
+    Call before the models are built: TensorFlow reads the thread counts when
+    its session is created and torch only accepts the inter-op count before
+    its first parallel operation. A count of 0 keeps the library default.
+
+    Args:
+        intra_op_threads: threads per TensorFlow op; also the default of `torch_threads`
+            and the OpenMP/BLAS pool size.
+        inter_op_threads: TensorFlow ops and torch inter-op tasks run concurrently.
+        torch_threads: intra-op threads of torch (UIS-RNN).
+        cpu_affinity: CPU list such as '0-3,6' to pin the process to.
+        gpu: value of CUDA_VISIBLE_DEVICES, '' to hide every GPU; None leaves it unchanged.
+        allow_growth: let TensorFlow allocate GPU memory on demand.
+    """
+    if cpu_affinity:
+        set_cpu_affinity(cpu_affinity)
+    if gpu is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = gpu
+    if intra_op_threads:
+        for var in THREAD_ENV_VARS:
+            os.environ[var] = str(intra_op_threads)
+    SETTINGS.update(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads,
+                    allow_growth=allow_growth)
+
+    torch_threads = torch_threads or intra_op_threads
+    if torch_threads or inter_op_threads:
+        import torch
+        if torch_threads:
+            torch.set_num_threads(torch_threads)
+        if inter_op_threads:
+            try:
+                torch.set_num_interop_threads(inter_op_threads)
+            except RuntimeError:
+                print('[WARNING] torch inter-op threads were already started, keeping their count')
+
+def spawn_pool(max_workers=None, **kwargs):
+    """ProcessPoolExecutor whose workers are spawned, not forked.
+
+    The parent holds TensorFlow state that is not fork-safe, so workers start
+    a fresh interpreter; they inherit the affinity and thread limits set by
+    configure(). `kwargs` go to ProcessPoolExecutor.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'), **kwargs)
+
+def tensorflow_config():
+    """Session config following the settings of configure()."""
+    import tensorflow as tf
+    config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads=SETTINGS['intra_op_threads'],
+                                      inter_op_parallelism_threads=SETTINGS['inter_op_threads'])
+    config.gpu_options.allow_growth = SETTINGS['allow_growth']
+    return config
+
+def add_arguments(parser):
+    """Add the runtime flags read by configure_from_args() to an argparse parser."""
+    group = parser.add_argument_group('runtime')
+    group.add_argument('--intra_op_threads', type=int, default=0,
+                       help='threads per TensorFlow op and for torch/OpenMP/BLAS; 0 keeps the library default')
+    group.add_argument('--inter_op_threads', type=int, default=0,
+                       help='TensorFlow ops and torch inter-op tasks run concurrently; 0 keeps the library default')
+    group.add_argument('--torch_threads', type=int, default=0,
+                       help='intra-op threads of UIS-RNN (torch); defaults to --intra_op_threads')
+    group.add_argument('--cpu_affinity', type=str, default='',
+                       help='pin the process and its workers to these CPUs, e.g. "0-3,6"')
+    group.add_argument('--gpu', type=str, default=None,
+                       help='CUDA_VISIBLE_DEVICES for both models, "" to run on the CPU only')
+    group.add_argument('--device', type=str, default='',
+                       help='torch device of UIS-RNN, e.g. "cpu" or "cuda:0"; picks cuda:0 when available if empty')
+    return group
+
+def configure_from_args(args):
+    configure(intra_op_threads=args.intra_op_threads,
+              inter_op_threads=args.inter_op_threads,
+              torch_threads=args.torch_threads,
+              cpu_affinity=args.cpu_affinity,
+              gpu=args.gpu)
@@ -1,30 +1,52 @@
 import os
 import collections
 import contextlib
+import hashlib
 import wave
+import numpy as np
 from pydub import AudioSegment
 
-def format_wave(wave_path):
+NORMALIZED_AUDIO_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'diarization', 'audio')
+
+def file_hash(path, block_size=1 << 20):
+    """SHA-1 hex digest of a file's content, read in blocks."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def normalize_audio(audio_path, cache_dir=NORMALIZED_AUDIO_DIR, sample_rate=16000):
+    """Return a mono 16-bit PCM .wav at `sample_rate` for any input audio.
+
+    Files that already have that format are used in place. Anything else
+    (mp3, stereo or resampled wav, ...) is decoded once and stored in
+    `cache_dir` under the hash of its content, so later runs on the same
+    file reuse the decoded PCM.
+    """
+    if is_canonical_wave(audio_path, sample_rate):
+        return audio_path
+    cached_path = os.path.join(cache_dir, '{}_{}.wav'.format(file_hash(audio_path), sample_rate))
+    if os.path.isfile(cached_path):
+        return cached_path
+    os.makedirs(cache_dir, exist_ok=True)
+    sound = AudioSegment.from_file(audio_path)
+    sound = sound.set_frame_rate(sample_rate).set_channels(1).set_sample_width(2)
+    # export next to the final name and rename, so a crash never leaves a
+    # truncated file in the cache
+    tmp_path = cached_path + '.part'
+    sound.export(tmp_path, format='wav')
+    os.replace(tmp_path, cached_path)
+    print(f'[INFO] Decoded "{os.path.basename(audio_path)}" to {cached_path}')
+    return cached_path
+
+def format_wave(wave_path, cache_dir=NORMALIZED_AUDIO_DIR):
     """Preprocess input wave file to meet required format for diarization process. 
     channel = 1
     sample rate = 16000
     audio extension = .wav 
     """
-    if wave_path.endswith(('mp3', 'MP3')): 
-        sound = AudioSegment.from_mp3(wave_path)
-        wave_path = wave_path[:-4] + '.wav'
-        sound = sound.set_frame_rate(16000).set_channels(1).set_sample_width(2)
-        sound.export(wave_path, format='wav')
-        print(f'[INFO] Saved wave file "{os.path.basename(wave_path)}" from mp3')
-        
-    elif wave_path.endswith(('wav', 'WAV')):
-        sound = AudioSegment.from_wav(wave_path)
-    
-    if sound.channels > 1 and sound.frame_rate != 16000 and sound.sample_width !=2:
-        sound = sound.set_frame_rate(16000).set_channels(1).set_sample_width(2)
-        sound.export(wave_path, format='wav')
-    
-    return wave_path
+    return normalize_audio(wave_path, cache_dir)
 
 def read_wave(path):
     """Reads a .wav file.
@@ -43,6 +65,77 @@ def read_wave(path):
         duration = frames / sample_rate
         return pcm_data, sample_rate, duration
 
+WaveHeader = collections.namedtuple('WaveHeader', ['channels', 'sample_rate', 'sample_width', 'data_offset', 'data_size'])
+
+def read_wave_header(path):
+    """Parses the RIFF header of a PCM .wav file without reading its data.
+
+    Returns a WaveHeader, or None if the file is not an uncompressed PCM wav.
+    """
+    with open(path, 'rb') as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            return None
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_id, chunk_size = chunk[:4], int.from_bytes(chunk[4:], 'little')
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                if chunk_size % 2:
+                    f.seek(1, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+        if fmt is None or len(fmt) < 16:
+            return None
+        format_tag = int.from_bytes(fmt[0:2], 'little')
+        if format_tag == 0xFFFE and len(fmt) >= 26:  # WAVE_FORMAT_EXTENSIBLE
+            format_tag = int.from_bytes(fmt[24:26], 'little')
+        if format_tag != 1:  # WAVE_FORMAT_PCM
+            return None
+        data_offset = f.tell()
+        available = os.path.getsize(path) - data_offset
+        if chunk_size in (0, 0xFFFFFFFF):
+            # Streaming writers leave the size unset; the data runs to the end of the file.
+            data_size = available
+        else:
+            # Streamed/truncated files may declare more data than they hold.
+            data_size = min(chunk_size, available)
+        return WaveHeader(channels=int.from_bytes(fmt[2:4], 'little'),
+                          sample_rate=int.from_bytes(fmt[4:8], 'little'),
+                          sample_width=int.from_bytes(fmt[14:16], 'little') // 8,
+                          data_offset=data_offset,
+                          data_size=data_size)
+
+def is_canonical_wave(path, sample_rate=16000):
+    """True if `path` is already mono 16-bit PCM at `sample_rate`."""
+    header = read_wave_header(path)
+    return (header is not None and header.channels == 1
+            and header.sample_width == 2 and header.sample_rate == sample_rate)
+
+def map_wave(path):
+    """Memory-maps a mono 16-bit PCM .wav file.
+
+    Returns (read-only np.int16 view of the samples, sample rate, duration).
+    Nothing is read into memory until the samples are accessed, so the
+    resident size does not grow with the length of the recording.
+    """
+    header = read_wave_header(path)
+    assert header is not None
+    assert header.channels == 1
+    assert header.sample_width == 2
+    assert header.sample_rate in (8000, 16000, 32000)
+    num_samples = header.data_size // 2
+    if num_samples:
+        samples = np.memmap(path, dtype='<i2', mode='r', offset=header.data_offset, shape=(num_samples,))
+    else:
+        samples = np.zeros(0, dtype=np.int16)
+    return samples, header.sample_rate, num_samples / header.sample_rate
+
 def write_wave(path, audio, sample_rate):
     """Writes a .wav file.
 
@@ -56,18 +149,50 @@ def write_wave(path, audio, sample_rate):
 
 
 class Frame(object):
-    """Represents a "frame" of audio data."""
-    def __init__(self, bytes, timestamp, duration):
+    """Represents a "frame" of audio data.
+
+    `bytes` is a memoryview into the source PCM buffer when the frame comes
+    from `frame_generator`, and `offset` is its first sample in that buffer.
+    """
+    __slots__ = ('bytes', 'timestamp', 'duration', 'offset')
+
+    def __init__(self, bytes, timestamp, duration, offset=0):
         self.bytes = bytes
         self.timestamp = timestamp
         self.duration = duration
+        self.offset = offset
 
 
 class Segment(object):
-    def __init__(self, bytes, begin, end):
-        self.bytes = bytes
+    """A voiced region of `audio`, the PCM buffer it was detected in.
+
+    The region is kept as `(start_sample, end_sample)` offsets into the
+    shared buffer; `bytes` copies it out only when asked for.
+    """
+    def __init__(self, audio, begin, end, start_sample=0, end_sample=None):
+        self.audio = audio
         self.begin = begin
         self.end = end
+        self.start_sample = start_sample
+        self.end_sample = len(byte_view(audio)) // 2 if end_sample is None else end_sample
+
+    @property
+    def num_samples(self):
+        return self.end_sample - self.start_sample
+
+    @property
+    def samples(self):
+        """The region as a zero-copy np.int16 view of the source buffer."""
+        return np.frombuffer(byte_view(self.audio)[self.start_sample * 2:self.end_sample * 2], dtype=np.int16)
+
+    @property
+    def bytes(self):
+        return byte_view(self.audio)[self.start_sample * 2:self.end_sample * 2].tobytes()
+
+
+def byte_view(audio):
+    """Return a flat, zero-copy byte memoryview over PCM audio data."""
+    return memoryview(audio).cast('B')
 
 
 def frame_generator(frame_duration_ms, audio, sample_rate):
@@ -76,19 +201,46 @@ def frame_generator(frame_duration_ms, audio, sample_rate):
     Takes the desired frame duration in milliseconds, the PCM data, and
     the sample rate.
 
-    Yields Frames of the requested duration.
+    Yields Frames of the requested duration. Frames are views into `audio`,
+    no PCM is copied.
     """
     frame_duration_s = frame_duration_ms / 1000.0
     frame_byte_count = int(sample_rate * frame_duration_s * 2)
+    audio = byte_view(audio)
     offset = 0
     timestamp = 0.0
     while offset + frame_byte_count -1 < len(audio):
-        yield Frame(audio[offset:offset + frame_byte_count], timestamp, frame_duration_s)
+        yield Frame(audio[offset:offset + frame_byte_count], timestamp, frame_duration_s, offset // 2)
         timestamp += frame_duration_s
         offset += frame_byte_count
 
+def stream_frame_generator(frame_duration_ms, chunks, sample_rate):
+    """Generates audio frames from PCM audio data arriving in chunks.
+
+    Takes the desired frame duration in milliseconds, an iterable of PCM
+    byte chunks of any size (e.g. reads from a pipe or socket), and the
+    sample rate. Bytes that do not fill a whole frame are carried over to
+    the next chunk.
+
+    Yields Frames of the requested duration.
+    """
+    frame_duration_s = frame_duration_ms / 1000.0
+    frame_byte_count = int(sample_rate * frame_duration_s * 2)
+    pending = bytearray()
+    timestamp = 0.0
+    sample_offset = 0
+    for chunk in chunks:
+        pending.extend(chunk)
+        offset = 0
+        while offset + frame_byte_count <= len(pending):
+            yield Frame(bytes(pending[offset:offset + frame_byte_count]), timestamp, frame_duration_s, sample_offset)
+            timestamp += frame_duration_s
+            offset += frame_byte_count
+            sample_offset += frame_byte_count // 2
+        del pending[:offset]
+
 def vad_collector(sample_rate, frame_duration_ms,
-                  padding_duration_ms, vad, frames):
+                  padding_duration_ms, vad, frames, max_segment_ms=None, audio=None, speech_flags=None):
     """Filters out non-voiced audio frames.
 
     Given a webrtcvad.Vad and a source of audio frames, yields only
@@ -111,23 +263,57 @@ def vad_collector(sample_rate, frame_duration_ms,
     padding_duration_ms - The amount to pad the window, in milliseconds.
     vad - An instance of webrtcvad.Vad.
     frames - a source of audio frames (sequence or generator).
+    max_segment_ms - If given, a voiced segment is yielded as soon as it
+        reaches this duration, which bounds the latency of streaming input.
+    audio - The PCM buffer the frames were cut from. When given, segments
+        reference it by sample offsets; otherwise (e.g. streamed frames)
+        each segment joins the bytes of its own frames.
+    speech_flags - Precomputed VAD decision of each frame, used instead of
+        calling `vad`, which may then be None.
 
-    Returns: A generator that yields PCM audio data.
+    Returns: A generator that yields Segments.
     """
     num_padding_frames = int(padding_duration_ms / frame_duration_ms)
+    max_segment_frames = int(max_segment_ms / frame_duration_ms) if max_segment_ms else None
     # We use a deque for our sliding window/ring buffer.
     ring_buffer = collections.deque(maxlen=num_padding_frames)
+    # Running count of voiced frames in the ring buffer.
+    num_voiced = 0
     # We have two states: TRIGGERED and NOTTRIGGERED. We start in the
     # NOTTRIGGERED state.
     triggered = False
-    
-    voiced_frames = []
-    for frame in frames:
-        is_speech = vad.is_speech(frame.bytes, sample_rate)
+
+    # The current voiced run is contiguous, so it is enough to remember its
+    # first and last frames (and the frame bytes when there is no buffer).
+    first_frame = last_frame = None
+    num_frames = 0
+    voiced_bytes = []
+
+    def make_segment():
+        if audio is None:
+            segment_audio = b''.join(voiced_bytes)
+            start_sample, end_sample = 0, len(segment_audio) // 2
+        else:
+            segment_audio = audio
+            start_sample = first_frame.offset
+            end_sample = last_frame.offset + len(last_frame.bytes) // 2
+        return Segment(segment_audio,
+                       first_frame.timestamp,
+                       last_frame.timestamp + last_frame.duration,
+                       start_sample, end_sample)
+
+    for index, frame in enumerate(frames):
+        if speech_flags is None:
+            is_speech = vad.is_speech(frame.bytes, sample_rate)
+        else:
+            is_speech = bool(speech_flags[index])
+        if ring_buffer.maxlen:
+            if len(ring_buffer) == ring_buffer.maxlen:
+                num_voiced -= ring_buffer[0][1]
+            num_voiced += is_speech
+        ring_buffer.append((frame, is_speech))
 
         if not triggered:
-            ring_buffer.append((frame, is_speech))
-            num_voiced = len([f for f, speech in ring_buffer if speech])
             # If we're NOTTRIGGERED and more than 90% of the frames in
             # the ring buffer are voiced frames, then enter the
             # TRIGGERED state.
@@ -136,31 +322,41 @@ def vad_collector(sample_rate, frame_duration_ms,
                 # We want to yield all the audio we see from now until
                 # we are NOTTRIGGERED, but we have to start with the
                 # audio that's already in the ring buffer.
-                for f, s in ring_buffer:
-                    voiced_frames.append(f)
+                first_frame = ring_buffer[0][0]
+                last_frame = frame
+                num_frames = len(ring_buffer)
+                if audio is None:
+                    voiced_bytes = [bytes(f.bytes) for f, s in ring_buffer]
                 ring_buffer.clear()
+                num_voiced = 0
         else:
             # We're in the TRIGGERED state, so collect the audio data
             # and add it to the ring buffer.
-            voiced_frames.append(frame)
-            ring_buffer.append((frame, is_speech))
-            num_unvoiced = len([f for f, speech in ring_buffer if not speech])
+            if first_frame is None:
+                first_frame = frame
+            last_frame = frame
+            num_frames += 1
+            if audio is None:
+                voiced_bytes.append(bytes(frame.bytes))
+            num_unvoiced = len(ring_buffer) - num_voiced
             # If more than 90% of the frames in the ring buffer are
             # unvoiced, then enter NOTTRIGGERED and yield whatever
             # audio we've collected.
             if num_unvoiced > 0.9 * ring_buffer.maxlen:
                 triggered = False
-                yield Segment(b''.join([f.bytes for f in voiced_frames]),
-                              voiced_frames[0].timestamp,
-                              voiced_frames[-1].timestamp + voiced_frames[-1].duration)
+                yield make_segment()
                 ring_buffer.clear()
-                voiced_frames = []
-    if triggered:
-        pass
+                num_voiced = 0
+                first_frame = last_frame = None
+                num_frames = 0
+                voiced_bytes = []
+            elif max_segment_frames and num_frames >= max_segment_frames:
+                # Stay TRIGGERED but flush what we have so far.
+                yield make_segment()
+                first_frame = last_frame = None
+                num_frames = 0
+                voiced_bytes = []
     # If we have any leftover voiced audio when we run out of input,
     # yield it.
-    if voiced_frames:
-        yield Segment(b''.join([f.bytes for f in voiced_frames]),
-                      voiced_frames[0].timestamp,
-                      voiced_frames[-1].timestamp + voiced_frames[-1].duration)
-
+    if num_frames:
+        yield make_segment()
@@ -1,8 +1,12 @@
 import webrtcvad
 import os
+import json
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from . import wavSplit
-from google.cloud import speech_v1 as speech
-from google.cloud.speech_v1 import enums, types
+from .featureFrontend import FeatureFrontend
 from tqdm import tqdm
 import contextlib
 import wave
@@ -16,15 +20,34 @@ class PrintFormat(object):
     
     def show_segments_info(segments):
         for seg in segments:
-            print(f"Speaker: {seg.speaker}, audio length : {len(seg.bytes)/16000/2}, begin:end = {seg.begin:.2f} : {seg.end:.2f}")
+            print(f"Speaker: {seg.speaker}, audio length : {seg.num_samples/16000}, begin:end = {seg.begin:.2f} : {seg.end:.2f}")
         
 
 class NewSegment(object):
-    def __init__(self, bytes, begin, end, speaker):
-        self.bytes = bytes
+    """A speaker turn made of one or more regions of the source audio.
+
+    `ranges` are (start_sample, end_sample) offsets into `audio`; the PCM
+    bytes are only joined when `bytes` is read.
+    """
+    def __init__(self, audio, ranges, begin, end, speaker):
+        self.audio = audio
+        self.ranges = ranges
         self.begin = begin
         self.end = end
         self.speaker = speaker
+
+    @property
+    def num_samples(self):
+        return sum(end - start for start, end in self.ranges)
+
+    def iter_bytes(self):
+        view = wavSplit.byte_view(self.audio)
+        for start, end in self.ranges:
+            yield view[start * 2:end * 2]
+
+    @property
+    def bytes(self):
+        return b''.join(self.iter_bytes())
  
 
 def arrange_segments(segments):
@@ -32,117 +55,273 @@ def arrange_segments(segments):
     Join same speaker segments if they are separted. 
     """
     new_segments = []
-    new_idx = 0
     
     for cur_idx, cur_segment in enumerate(segments):
-        if cur_idx==0:
-            new_segments.append(NewSegment(cur_segment.bytes,
-                                            cur_segment.begin,
-                                            cur_segment.end, 
-                                            cur_segment.speaker))
-        elif cur_idx > 0:
-            prev_segment = segments[cur_idx-1]
-            change_flag = False if prev_segment.speaker==cur_segment.speaker else True # check speaker tag with previous and current segment
-            if change_flag:
-                new_segments.append(NewSegment(cur_segment.bytes,
-                                               cur_segment.begin,
-                                               cur_segment.end,
-                                               cur_segment.speaker))
-                new_idx = cur_idx
+        if cur_idx > 0 and segments[cur_idx-1].speaker == cur_segment.speaker \
+                and segments[cur_idx-1].audio is cur_segment.audio:
+            new = new_segments[-1]
+            last_start, last_end = new.ranges[-1]
+            if last_end == cur_segment.start_sample:
+                new.ranges[-1] = (last_start, cur_segment.end_sample)
             else:
-                new = new_segments[-1]
-                new_audio = new.bytes + cur_segment.bytes
-                new_segments[-1] = NewSegment(new_audio,
-                                              segments[new_idx].begin,
-                                              cur_segment.end,
-                                              cur_segment.speaker)
+                new.ranges.append((cur_segment.start_sample, cur_segment.end_sample))
+            new.end = cur_segment.end
+        else:
+            new_segments.append(NewSegment(cur_segment.audio,
+                                           [(cur_segment.start_sample, cur_segment.end_sample)],
+                                           cur_segment.begin,
+                                           cur_segment.end,
+                                           cur_segment.speaker))
     return new_segments
 
-def vad_segment_generator(wavFile, aggressiveness, frame_duration_ms=30, padding_duration_ms=300):
+def vad_segment_generator(wavFile, aggressiveness, frame_duration_ms=30, padding_duration_ms=300,
+                          cache_dir=wavSplit.NORMALIZED_AUDIO_DIR, feature_cache=None, frontend=None):
     """Voice acitivity detection for speech recognition
+
+    With a `featureCache.FeatureCache`, segment offsets are reused from an
+    earlier run with the same VAD parameters. Pass the `FeatureFrontend` of
+    `wavFile` to share its per-frame VAD decisions with later stages
+    (e.g. the silence check of `write_stt`).
     """
-    wavFile = wavSplit.format_wave(wavFile) # formatting the input audio file for diarization
-    audio, sample_rate, audio_length = wavSplit.read_wave(wavFile) 
-    vad = webrtcvad.Vad(int(aggressiveness))
-    frames = wavSplit.frame_generator(frame_duration_ms, audio, sample_rate)
-    frames = list(frames)
-    segments = wavSplit.vad_collector(sample_rate, frame_duration_ms, padding_duration_ms, vad, frames)
+    if frontend is None:
+        frontend = FeatureFrontend.from_file(wavFile, aggressiveness, frame_duration_ms, cache_dir, feature_cache)
+    audio, sample_rate, audio_length = frontend.audio, frontend.sample_rate, frontend.duration
+    if feature_cache is not None:
+        feature_cache.add_params(aggressiveness=int(aggressiveness),
+                                 frame_duration_ms=frame_duration_ms,
+                                 padding_duration_ms=padding_duration_ms)
+        regions = feature_cache.load('vad')
+        if regions is not None:
+            segments = [wavSplit.Segment(audio, begin, end, int(start_sample), int(end_sample))
+                        for start_sample, end_sample, begin, end in regions]
+            return segments, sample_rate, audio_length
+    segments = frontend.segments(padding_duration_ms)
+    if feature_cache is not None:
+        regions = np.array([[segment.start_sample, segment.end_sample, segment.begin, segment.end]
+                            for segment in segments], dtype=float).reshape(-1, 4)
+        feature_cache.save('vad', regions)
 
-    return [segment for segment in segments], sample_rate, audio_length 
+    return segments, sample_rate, audio_length 
 
 def write_wave(audio, wav_name, sample_rate):
     """Writes a .wav file.
-    Takes path, PCM audio data, and sample rate.
+    Takes path, PCM audio data (bytes or an iterable of byte chunks), and sample rate.
     """
+    if isinstance(audio, (bytes, bytearray, memoryview)):
+        audio = [audio]
     with contextlib.closing(wave.open(wav_name, 'wb')) as wf:
         wf.setnchannels(1)
         wf.setsampwidth(2)
         wf.setframerate(sample_rate)
-        wf.writeframes(audio)
+        for chunk in audio:
+            wf.writeframes(chunk)
+
+def write_audio_segments(segments, output_path, input_file_name, sample_rate=16000, output_name=None):
+    """Write audio wave segments as diarization output
 
-def write_audio_segments(segments, output_path, input_file_name, sample_rate=16000):
-    """Write audio wave segments as diarization output"""
-    output_path = os.path.join(output_path, os.path.splitext(os.path.basename(input_file_name))[0])
+    They go to `output_path/<output_name>`, by default the name of the input file without extension.
+    """
+    output_name = output_name or os.path.splitext(os.path.basename(input_file_name))[0]
+    output_path = os.path.join(output_path, output_name)
     os.makedirs(output_path, exist_ok=True)
     pairs  = find_pair(segments)
     for i, segment in enumerate(segments):
         segment.speaker = pairs[segment.speaker]
-        duration = len(segment.bytes)/sample_rate/2
+        duration = segment.num_samples/sample_rate
         tq = tqdm(total=duration)
         speaker = chr(ord("A")+segment.speaker)
         tq.set_description('{}. Speaker {}'.format(i, speaker))
         output_wave = os.path.join(output_path, "{}_Speaker_{}_{:.2f}_sec.wav".format(i, speaker, duration))
-        write_wave(segment.bytes, output_wave, sample_rate)
+        write_wave(segment.iter_bytes(), output_wave, sample_rate)
         tq.update(duration)
         tq.close() 
     
-def write_stt(segments, transcript_file, aggressive=3, sample_rate=16000, silence_thresh=1):
-    """Writes audio speakers's segments with google speech recognition to a text file
+def speaker_names(segments, window_labels=()):
+    """Letter of each speaker label, in order of first appearance as in the other writers.
+
+    Labels that only occur in `window_labels` get the following letters.
+    """
+    pairs = find_pair(segments) if segments else {}
+    for label in window_labels:
+        if label not in pairs:
+            pairs[label] = len(pairs)
+    return {label: chr(ord("A") + index) for label, index in pairs.items()}
+
+def write_rttm(segments, rttm_file, file_id, sample_rate=16000, windows=None):
+    """Write speaker segments as RTTM SPEAKER lines, from their sample offsets only.
+
+    Each VAD segment gives one line, with its majority-vote confidence in
+    the confidence field. With `windows`, (begin, end, label) of every
+    utterance window, one line per window is written instead.
+    """
+    window_labels = [label for _, _, label in windows] if windows is not None else ()
+    names = speaker_names(segments, window_labels)
+    line = 'SPEAKER {} 1 {:.3f} {:.3f} <NA> <NA> {} {} <NA>\n'
+    with open(rttm_file, 'w') as f:
+        if windows is not None:
+            for begin, end, label in windows:
+                f.write(line.format(file_id, begin, end - begin, names[label], '<NA>'))
+        else:
+            for segment in segments:
+                begin = segment.start_sample / sample_rate
+                f.write(line.format(file_id, begin, segment.end_sample / sample_rate - begin, names[segment.speaker],
+                                    '{:.3f}'.format(getattr(segment, 'confidence', 1.0))))
+
+def write_json(segments, json_file, file_id, sample_rate=16000, windows=None):
+    """Write speaker segments, and optionally the utterance `windows`, as JSON, from sample offsets only."""
+    window_labels = [label for _, _, label in windows] if windows is not None else ()
+    names = speaker_names(segments, window_labels)
+    result = {'file': file_id,
+              'segments': [{'begin': round(segment.start_sample / sample_rate, 3),
+                            'end': round(segment.end_sample / sample_rate, 3),
+                            'speaker': names[segment.speaker],
+                            'confidence': round(float(getattr(segment, 'confidence', 1.0)), 3)}
+                           for segment in segments]}
+    if windows is not None:
+        result['windows'] = [{'begin': round(float(begin), 3), 'end': round(float(end), 3), 'speaker': names[label]}
+                             for begin, end, label in windows]
+    with open(json_file, 'w') as f:
+        json.dump(result, f, indent=1)
+
+class GoogleRecognizer(object):
+    """Google Cloud Speech-to-Text for mono 16-bit PCM of at most one minute.
+
+    Recognizers only need `recognize(audio_bytes)`, returning the transcript
+    ('' when nothing is recognized), and `retryable`, the exceptions worth
+    retrying. The client is thread-safe, so one instance serves every worker.
+    """
+    def __init__(self, sample_rate=16000, language_code='en-US'):
+        from google.api_core import exceptions
+        from google.cloud import speech_v1 as speech
+        from google.cloud.speech_v1 import enums, types
+        self.types = types
+        self.client = speech.SpeechClient()
+        self.config = types.RecognitionConfig(encoding=enums.RecognitionConfig.AudioEncoding.LINEAR16,
+                                              sample_rate_hertz=sample_rate,
+                                              language_code=language_code)
+        self.retryable = (exceptions.ServiceUnavailable, exceptions.DeadlineExceeded,
+                          exceptions.ResourceExhausted, exceptions.InternalServerError)
+
+    def recognize(self, audio_bytes):
+        response = self.client.recognize(self.config, self.types.RecognitionAudio(content=audio_bytes))
+        if not response.results:
+            return ""
+        return response.results[0].alternatives[0].transcript.capitalize()
+
+
+class StubRecognizer(object):
+    """Offline recognizer returning a fixed transcript, e.g. for tests or timing runs without network."""
+    retryable = ()
+
+    def __init__(self, sample_rate=16000, transcript=""):
+        self.transcript = transcript
+
+    def recognize(self, audio_bytes):
+        return self.transcript
+
+
+RECOGNIZERS = {'google': GoogleRecognizer, 'stub': StubRecognizer}
+
+
+class RateLimiter(object):
+    """Spaces calls to `wait()` at least 1 / `rate` seconds apart across threads; no limit when `rate` is 0."""
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        time.sleep(slot - now)
+
+
+def transcribe(audios, recognizer, sample_rate=16000, workers=8, max_requests_per_sec=0, retries=3, retry_delay=1.0,
+               time_limit=60):
+    """Transcribe PCM byte strings concurrently, yielding their transcripts in input order.
+
+    Audio longer than `time_limit` seconds is recognized in pieces whose
+    transcripts are joined. Requests run on `workers` threads, at most
+    `max_requests_per_sec` of them per second (0: unlimited), and failures
+    in `recognizer.retryable` are retried `retries` times with exponential
+    backoff. Only about 2 * `workers` inputs are held at a time. A None
+    input (e.g. a silent segment) yields None without a request.
     """
+    limiter = RateLimiter(max_requests_per_sec)
+
+    def recognize(audio):
+        for attempt in range(retries + 1):
+            limiter.wait()
+            try:
+                return recognizer.recognize(audio)
+            except recognizer.retryable as e:
+                if attempt == retries:
+                    raise
+                print('[WARNING] speech recognition failed ({}), retrying'.format(e))
+                time.sleep(retry_delay * 2 ** attempt)
+
+    def result(futures):
+        if futures is None:
+            return None
+        texts = [future.result() for future in futures]
+        if len(texts) == 1:
+            return texts[0] or "..."
+        return "".join(texts)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for audio in audios:
+            if audio is None:
+                pending.append(None)
+            elif len(audio)/sample_rate/2 <= time_limit:
+                pending.append([pool.submit(recognize, audio)])
+            else:
+                pending.append([pool.submit(recognize, split_audio)
+                                for split_audio in gen_bytes_with_limit(audio, sample_rate, time_limit)])
+            while len(pending) > 2 * workers:
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
+
+def write_stt(segments, transcript_file, aggressive=3, sample_rate=16000, silence_thresh=1, frontend=None,
+              recognizer=None, workers=8, max_requests_per_sec=0, retries=3):
+    """Writes audio speakers's segments with speech recognition to a text file
+
+    Segments are recognized concurrently by `transcribe` with `recognizer`
+    (a `GoogleRecognizer` by default) and written in order. With the
+    `FeatureFrontend` the segments were detected with, the silence check
+    looks up its frame decisions instead of running the VAD again.
+    """
+    if recognizer is None:
+        recognizer = GoogleRecognizer(sample_rate)
     vad = webrtcvad.Vad(aggressive)
-    client = speech.SpeechClient()
-    config = types.RecognitionConfig(encoding=enums.RecognitionConfig.AudioEncoding.LINEAR16,
-                                     sample_rate_hertz=sample_rate,
-                                     language_code='en-US') 
-    with open(transcript_file, 'w') as f:
-        pairs  = find_pair(segments)
-        for i, segment in enumerate(segments):
-            segment.speaker = pairs[segment.speaker]
-            duration = len(segment.bytes)/sample_rate/2
-            tq = tqdm(total=duration)
+    pairs  = find_pair(segments)
+    for segment in segments:
+        segment.speaker = pairs[segment.speaker]
+
+    def voiced_audio():
+        for segment in segments:
+            if frontend is not None:
+                silence_flag = frontend.is_silent(segment.ranges, silence_thresh)
+                yield None if silence_flag else segment.bytes
+            else:
+                audio = segment.bytes
+                silence_flag = check_silence(audio, vad, sample_rate=sample_rate, frame_duration_ms=30, silence_thresh= silence_thresh)
+                yield None if silence_flag else audio
+
+    transcripts = transcribe(voiced_audio(), recognizer, sample_rate, workers, max_requests_per_sec, retries)
+    with open(transcript_file, 'w') as f, tqdm(total=sum(segment.num_samples for segment in segments)/sample_rate) as tq:
+        for i, (segment, text_string) in enumerate(zip(segments, transcripts)):
             speaker = chr(ord("A")+segment.speaker)
             tq.set_description('{}. Speaker {}'.format(i, speaker))
-            silence_flag = check_silence(segment.bytes, vad, sample_rate=sample_rate, frame_duration_ms=30, silence_thresh= silence_thresh)
-            if not silence_flag:
-                output = segment_to_text(client, config, segment, sample_rate)
-                
-            else:
-                output= PrintFormat.speaker_text(speaker, text_string='...') 
+            output = PrintFormat.speaker_text(speaker, text_string='...' if text_string is None else text_string)
             f.write("{}. {}".format(i, output))
-            f.flush()   
-            tq.update(duration)
-            tq.close()
-
-def segment_to_text(client, config, segment, sample_rate=16000): 
-    speaker = chr(ord("A")+segment.speaker) 
-    if len(segment.bytes)/sample_rate/2 <= 60: # check whethere segment is more than 1 minute or not
-        audio = types.RecognitionAudio(content = segment.bytes)
-        response = client.recognize(config, audio)
-        if not response.results:
-            text_strings = "..."
-        else:
-            text_strings = response.results[0].alternatives[0].transcript.capitalize() 
-    else:
-        split_audios = gen_bytes_with_limit(segment.bytes, sample_rate, time_limit= 60)
-        text_strings = ""
-        for split_audio in split_audios:
-            audio = types.RecognitionAudio(content = split_audio)
-            response = client.recognize(config, audio)
-            text_string = "" if not response.results else response.results[0].alternatives[0].transcript.capitalize()
-            text_strings += text_string
-            
-    text = PrintFormat.speaker_text(speaker, text_string = text_strings)                   
-    return text
+            f.flush()
+            tq.update(segment.num_samples/sample_rate)
 
 def gen_bytes_with_limit(audio, sample_rate, time_limit=60): 
     frame_byte_count = int(sample_rate * time_limit * 2)
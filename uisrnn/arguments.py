@@ -76,6 +76,12 @@ def parse_arguments():
       help='The value of sigma squared, corresponding to Eq. (11) in the '
            'paper. If the value is given, we will fix to this value. If the '
            'value is None, we will estimate it from training data.')
+  model_parser.add_argument(
+      '--device',
+      default='',
+      type=str,
+      help='The torch device of the model, e.g. "cpu" or "cuda:0". If empty, '
+           'cuda:0 is used when available, otherwise the CPU.')
   model_parser.add_argument(
       '--verbosity',
       default=2,
@@ -185,6 +191,20 @@ def parse_arguments():
            'sequence, and run inference on this concatenated sequence. '
            'Then we return the inference results on the last duplicate as the '
            'final prediction for the test sequence.')
+  inference_parser.add_argument(
+      '--warmup_length',
+      default=0,
+      type=int,
+      help='If positive, the first test_iteration - 1 passes only run over '
+           'the first warmup_length entries of the test sequence, which warms '
+           'up the beam states at a fraction of the cost of a full duplicate. '
+           'If 0, every pass covers the whole sequence.')
+  inference_parser.add_argument(
+      '--predict_workers',
+      default=0,
+      type=int,
+      help='If above 1, predicting a list of test sequences on the CPU is '
+           'split across this many spawned worker processes.')
   inference_parser.add_argument(
       '--num_speaker',
       default=0,
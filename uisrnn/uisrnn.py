@@ -13,6 +13,9 @@
 # limitations under the License.
 """The UIS-RNN model."""
 
+import copy
+import multiprocessing
+
 import numpy as np
 import torch
 from torch import autograd
@@ -26,6 +29,23 @@ from tqdm import tqdm
 
 _INITIAL_SIGMA2_VALUE = 0.1
 
+# (model, test_sequences, args) of a predict pool worker.
+_PREDICT_WORKER_STATE = None
+
+
+def _init_predict_worker(model, test_sequences, args):
+  """Receive the model and the sequences once per pool worker."""
+  global _PREDICT_WORKER_STATE
+  _PREDICT_WORKER_STATE = (model, test_sequences, args)
+  # one thread per worker; the pool provides the parallelism
+  torch.set_num_threads(1)
+
+
+def _predict_chunk(indices):
+  """Run `predict_batch()` on some of the sequences in a pool worker."""
+  model, test_sequences, args = _PREDICT_WORKER_STATE
+  return model.predict_batch([test_sequences[i] for i in indices], args)
+
 
 class CoreRNN(nn.Module):
   """The core Recurent Neural Network used by UIS-RNN."""
@@ -49,29 +69,79 @@ class CoreRNN(nn.Module):
     return mean, hidden
 
 
+class _TraceNode:
+  """An immutable link of a cluster trace, shared by all beams extending it."""
+
+  __slots__ = ('cluster', 'parent', 'length')
+
+  def __init__(self, cluster, parent):
+    self.cluster = cluster
+    self.parent = parent
+    self.length = 1 if parent is None else parent.length + 1
+
+
 class BeamState:
-  """Structure that contains necessary states for beam search."""
+  """Structure that contains necessary states for beam search.
+
+  The trace is a persistent linked list, so cloning a state shares its whole
+  history instead of copying it. `cluster_counts` keeps the number of
+  occurrences of each cluster in the trace, so updates never rescan it.
+  """
+
+  __slots__ = ('mean_set', 'hidden_set', 'neg_likelihood', 'block_counts',
+               'cluster_counts', '_trace')
 
   def __init__(self, source=None):
-    if not source:
+    if source is None:
       self.mean_set = []
       self.hidden_set = []
       self.neg_likelihood = 0
-      self.trace = []
       self.block_counts = []
+      self.cluster_counts = []
+      self._trace = None
     else:
       self.mean_set = source.mean_set.copy()
       self.hidden_set = source.hidden_set.copy()
-      self.trace = source.trace.copy()
       self.block_counts = source.block_counts.copy()
+      self.cluster_counts = source.cluster_counts.copy()
+      self._trace = source._trace
       self.neg_likelihood = source.neg_likelihood
 
+  @property
+  def last_cluster(self):
+    """The last cluster of the trace."""
+    return self._trace.cluster
+
+  @property
+  def trace(self):
+    """The full cluster trace, as a list."""
+    return self.recent_trace(len(self))
+
+  def __len__(self):
+    return 0 if self._trace is None else self._trace.length
+
+  def recent_trace(self, length):
+    """Return the last `length` clusters of the trace, as a list."""
+    recent = []
+    node = self._trace
+    while node is not None and len(recent) < length:
+      recent.append(node.cluster)
+      node = node.parent
+    recent.reverse()
+    return recent
+
+  def extend_trace(self, cluster):
+    """Append a cluster assignment to the trace."""
+    self._trace = _TraceNode(cluster, self._trace)
+    self.cluster_counts[cluster] += 1
+
   def append(self, mean, hidden, cluster):
     """Append new item to the BeamState."""
     self.mean_set.append(mean.clone())
     self.hidden_set.append(hidden.clone())
     self.block_counts.append(1)
-    self.trace.append(cluster)
+    self.cluster_counts.append(0)
+    self.extend_trace(cluster)
 
 
 class UISRNN:
@@ -85,7 +155,8 @@ class UISRNN:
     """
     self.observation_dim = args.observation_dim
     self.device = torch.device(
-        'cuda:0' if torch.cuda.is_available() else 'cpu')
+        getattr(args, 'device', '') or
+        ('cuda:0' if torch.cuda.is_available() else 'cpu'))
     self.rnn_model = CoreRNN(self.observation_dim, args.rnn_hidden_size,
                              args.rnn_depth, self.observation_dim,
                              args.rnn_dropout).to(self.device)
@@ -149,7 +220,7 @@ class UISRNN:
     Args:
       filepath: the path of the file.
     """
-    var_dict = torch.load(filepath)
+    var_dict = torch.load(filepath, map_location=self.device)
     self.rnn_model.load_state_dict(var_dict['rnn_state_dict'])
     self.rnn_init_hidden = nn.Parameter(
         torch.from_numpy(var_dict['rnn_init_hidden']).to(self.device))
@@ -188,6 +259,12 @@ class UISRNN:
         Here `N=5`, `D=4`.
 
         We concatenate all training utterances into this single sequence.
+        Any floating dtype is accepted, including a read-only `np.memmap`
+        (e.g. a shard of an embedding store). It is still copied into RAM:
+        resizing gathers every cluster's rows `args.num_permutations` times,
+        so memory grows with the sequence size times the number of
+        permutations. Fit large data one shard at a time to keep that bound
+        at one shard.
       train_cluster_id: the speaker id sequence, which is 1-dim list or
         numpy array of strings, of size `N`.
         For example,
@@ -207,7 +284,7 @@ class UISRNN:
     """
     # check type
     if (not isinstance(train_sequence, np.ndarray) or
-        train_sequence.dtype != float):
+        not np.issubdtype(train_sequence.dtype, np.floating)):
       raise TypeError('train_sequence should be a numpy array of float type.')
     if isinstance(train_cluster_id, list):
       train_cluster_id = np.array(train_cluster_id)
@@ -395,7 +472,7 @@ class UISRNN:
         new_beam_state.neg_likelihood = float('inf')
         break
       elif cluster < len(new_beam_state.mean_set):  # existing cluster
-        last_cluster = new_beam_state.trace[-1]
+        last_cluster = new_beam_state.last_cluster
         loss = loss_func.weighted_mse_loss(
             input_tensor=torch.squeeze(new_beam_state.mean_set[cluster]),
             target_tensor=look_ahead_seq[sub_idx, :],
@@ -410,15 +487,13 @@ class UISRNN:
         mean, hidden = self.rnn_model(
             look_ahead_seq[sub_idx, :].unsqueeze(0).unsqueeze(0),
             new_beam_state.hidden_set[cluster])
+        count = float(new_beam_state.cluster_counts[cluster])
         new_beam_state.mean_set[cluster] = (new_beam_state.mean_set[cluster]*(
-            (np.array(new_beam_state.trace) == cluster).sum() -
-            1).astype(float) + mean.clone()) / (
-                np.array(new_beam_state.trace) == cluster).sum().astype(
-                    float)  # use mean to predict
+            count - 1) + mean.clone()) / count  # use mean to predict
         new_beam_state.hidden_set[cluster] = hidden.clone()
         if cluster != last_cluster:
           new_beam_state.block_counts[cluster] += 1
-        new_beam_state.trace.append(cluster)
+        new_beam_state.extend_trace(cluster)
       else:  # new cluster
         init_input = autograd.Variable(
             torch.zeros(self.observation_dim)
@@ -494,6 +569,30 @@ class UISRNN:
         an array of integers, of size `N`.
         For example, `predicted_cluster_id = [0, 1, 0, 0, 1]`
 
+    Raises:
+      TypeError: If test_sequence is of wrong type.
+      ValueError: If test_sequence has wrong dimension.
+    """
+    test_sequence_length = self._check_test_sequence(test_sequence)
+
+    self.rnn_model.eval()
+    test_sequence = autograd.Variable(
+        torch.from_numpy(test_sequence).float()).to(self.device)
+    order = self._inference_order(test_sequence_length, args)
+    # bookkeeping for beam search
+    beam_set = [BeamState()]
+    for num_iter in tqdm(np.arange(0, len(order), args.look_ahead),
+                         desc = 'Clustering Utterance Features'):
+      look_ahead_idx = torch.from_numpy(
+          order[num_iter:  num_iter + args.look_ahead]).to(self.device)
+      look_ahead_seq = test_sequence[look_ahead_idx, :]
+      beam_set = self._beam_search_step(beam_set, look_ahead_seq, args)
+    predicted_cluster_id = beam_set[0].recent_trace(test_sequence_length)
+    return predicted_cluster_id
+
+  def _check_test_sequence(self, test_sequence):
+    """Validate a test sequence and return its length.
+
     Raises:
       TypeError: If test_sequence is of wrong type.
       ValueError: If test_sequence has wrong dimension.
@@ -510,17 +609,39 @@ class UISRNN:
     if observation_dim != self.observation_dim:
       raise ValueError('test_sequence does not match the dimension specified '
                        'by args.observation_dim.')
+    return test_sequence_length
 
-    self.rnn_model.eval()
-    test_sequence = np.tile(test_sequence, (args.test_iteration, 1))
-    test_sequence = autograd.Variable(
-        torch.from_numpy(test_sequence).float()).to(self.device)
-    # bookkeeping for beam search
-    beam_set = [BeamState()]
-    for num_iter in tqdm(np.arange(0, args.test_iteration * test_sequence_length,
-                              args.look_ahead), desc = 'Clustering Utterance Features'):
+  def _inference_order(self, test_sequence_length, args):
+    """Indices of the test sequence entries, in the order they are decoded.
+
+    Instead of tiling the sequence test_iteration times, walk an index
+    order over the same tensor. The first test_iteration - 1 passes only
+    warm up the beams, so they may be limited to a prefix.
+    """
+    warmup_length = test_sequence_length
+    if getattr(args, 'warmup_length', 0) > 0:
+      warmup_length = min(args.warmup_length, test_sequence_length)
+    return np.concatenate(
+        [np.tile(np.arange(warmup_length), args.test_iteration - 1),
+         np.arange(test_sequence_length)]).astype(int)
+
+  def _beam_search_step(self, beam_set, look_ahead_seq, args):
+    """Advance the beam search by one look ahead sequence.
+
+    Args:
+      beam_set: a list of BeamState objects, best first.
+      look_ahead_seq: Look ahead sequence, size: look_ahead*D.
+      args: Inference configurations. See `arguments.py` for details.
+
+    Returns:
+      updated_beam_set: the new list of BeamState objects, best first.
+    """
+    # look_ahead > 1 runs the GRU in _update_beam_state, also without autograd
+    with torch.no_grad():
+      if look_ahead_seq.shape[0] == 1:
+        return self._batched_beam_search_step(
+            beam_set, look_ahead_seq[0], args)
       max_clusters = max([len(beam_state.mean_set) for beam_state in beam_set])
-      look_ahead_seq = test_sequence[num_iter:  num_iter + args.look_ahead, :]
       look_ahead_seq_length = look_ahead_seq.shape[0]
       score_set = float('inf') * np.ones(
           np.append(
@@ -534,24 +655,193 @@ class UISRNN:
             np.tile([[0, max_clusters - len(beam_state.mean_set)]],
                     (look_ahead_seq_length, 1)), 'constant',
             constant_values=float('inf'))
-      # find top scores
-      score_ranked = np.sort(score_set, axis=None)
-      score_ranked[score_ranked == float('inf')] = 0
-      score_ranked = np.trim_zeros(score_ranked)
-      idx_ranked = np.argsort(score_set, axis=None)
       updated_beam_set = []
-      for new_beam_rank in range(
-          np.min((len(score_ranked), args.beam_size))):
-        total_idx = np.unravel_index(idx_ranked[new_beam_rank],
-                                     score_set.shape)
+      for total_idx in self._rank_scores(score_set, args.beam_size):
         prev_beam_rank = total_idx[0]
         cluster_seq = total_idx[1:]
         updated_beam_state = self._update_beam_state(
             beam_set[prev_beam_rank], look_ahead_seq, cluster_seq)
         updated_beam_set.append(updated_beam_state)
-      beam_set = updated_beam_set
-    predicted_cluster_id = beam_set[0].trace[-test_sequence_length:]
-    return predicted_cluster_id
+      return updated_beam_set
+
+  def _rank_scores(self, score_set, beam_size):
+    """Return the indices of the best finite scores, at most beam_size."""
+    # find top scores
+    score_ranked = np.sort(score_set, axis=None)
+    score_ranked[score_ranked == float('inf')] = 0
+    score_ranked = np.trim_zeros(score_ranked)
+    idx_ranked = np.argsort(score_set, axis=None)
+    return [np.unravel_index(idx_ranked[new_beam_rank], score_set.shape)
+            for new_beam_rank in range(np.min((len(score_ranked), beam_size)))]
+
+  def _batched_beam_search_step(self, beam_set, observation, args):
+    """Advance the beam search by one observation with batched tensor ops.
+
+    Equivalent to `_beam_search_step()` with a look ahead of 1. The scores of
+    all beams x all candidate clusters are computed from the stored cluster
+    means in one tensor operation, and the GRU is only run for the surviving
+    top `beam_size` candidates, as a single batched step.
+
+    Args:
+      beam_set: a list of BeamState objects, best first.
+      observation: the next observation, a tensor of size D.
+      args: Inference configurations. See `arguments.py` for details.
+
+    Returns:
+      updated_beam_set: the new list of BeamState objects, best first.
+    """
+    return self._multi_beam_search_step(
+        [beam_set], observation.view(1, -1), args)[0]
+
+  def _multi_beam_search_step(self, beam_sets, observations, args):
+    """Advance the beam searches of independent sequences by one observation.
+
+    Like `_batched_beam_search_step()`, but for many sequences at once: the
+    scores of every beam of every sequence come from one tensor operation,
+    and the GRU runs once for the survivors of all sequences together.
+
+    Args:
+      beam_sets: a list of beam sets, one per sequence, each a list of
+        BeamState objects, best first.
+      observations: the next observation of each sequence, a tensor of size
+        `len(beam_sets) * D`.
+      args: Inference configurations. See `arguments.py` for details.
+
+    Returns:
+      updated_beam_sets: the new beam set of each sequence.
+    """
+    weight = 1 / (2 * self.sigma2)
+    log_bias = np.log(self.transition_bias)
+    log_stay = np.log(1 - self.transition_bias)
+
+    # the state of a new cluster does not depend on the beam
+    init_input = torch.zeros(1, 1, self.observation_dim).to(self.device)
+    init_mean, init_hidden = self.rnn_model(init_input, self.rnn_init_hidden)
+    new_cluster_loss = (((init_mean.view(1, -1) - observations) ** 2) *
+                        weight).sum(dim=1).cpu().numpy()
+
+    means = []
+    mean_sequence = []
+    for seq_idx, beam_set in enumerate(beam_sets):
+      for beam_state in beam_set:
+        means.extend(beam_state.mean_set)
+        mean_sequence.extend([seq_idx] * len(beam_state.mean_set))
+    if means:
+      stacked_means = torch.cat([mean.view(1, -1) for mean in means])
+      existing_loss = (
+          ((stacked_means - observations[mean_sequence]) ** 2) *
+          weight).sum(dim=1).cpu().numpy()
+    offset = 0
+    score_sets = []
+    survivor_sets = []
+    for seq_idx, beam_set in enumerate(beam_sets):
+      max_clusters = max([len(beam_state.mean_set) for beam_state in beam_set])
+      # float32 like `_update_beam_state()`, which adds the float32 loss of
+      # each step to the likelihood in float32
+      score_set = np.full((args.beam_size, max_clusters + 1), np.inf,
+                          dtype=np.float32)
+      for beam_rank, beam_state in enumerate(beam_set):
+        num_clusters = len(beam_state.mean_set)
+        neg_likelihood = np.float32(beam_state.neg_likelihood)
+        block_counts = np.array(beam_state.block_counts, dtype=float)
+        log_total = np.log(block_counts.sum() + self.crp_alpha)
+        if num_clusters:
+          transition_loss = -(log_bias + np.log(block_counts) - log_total)
+          transition_loss[beam_state.last_cluster] = -log_stay
+          score_set[beam_rank, :num_clusters] = neg_likelihood + (
+              existing_loss[offset:offset + num_clusters] +
+              transition_loss.astype(np.float32))
+          offset += num_clusters
+        score_set[beam_rank, num_clusters] = neg_likelihood + (
+            new_cluster_loss[seq_idx] -
+            np.float32(log_bias + np.log(self.crp_alpha) - log_total))
+      if args.num_speaker:
+        score_set[:, args.num_speaker:] = float('inf')
+      score_sets.append(score_set)
+      survivor_sets.append(self._rank_scores(score_set, args.beam_size))
+
+    # only materialize the surviving candidates, in one GRU step
+    inputs = []
+    hiddens = []
+    for seq_idx, (beam_set, survivors) in enumerate(
+        zip(beam_sets, survivor_sets)):
+      for prev_beam_rank, cluster in survivors:
+        beam_state = beam_set[prev_beam_rank]
+        if cluster < len(beam_state.mean_set):
+          hiddens.append(beam_state.hidden_set[cluster])
+        else:
+          hiddens.append(init_hidden)
+        inputs.append(seq_idx)
+    if not inputs:
+      return [[] for _ in beam_sets]
+    mean, hidden = self.rnn_model(
+        observations[inputs].unsqueeze(0), torch.cat(hiddens, dim=1))
+
+    updated_beam_sets = []
+    idx = 0
+    for beam_set, survivors, score_set in zip(
+        beam_sets, survivor_sets, score_sets):
+      updated_beam_set = []
+      for prev_beam_rank, cluster in survivors:
+        new_beam_state = BeamState(beam_set[prev_beam_rank])
+        new_mean = mean[:, idx:idx + 1, :]
+        new_hidden = hidden[:, idx:idx + 1, :]
+        idx += 1
+        if cluster < len(new_beam_state.mean_set):  # existing cluster
+          count = float(new_beam_state.cluster_counts[cluster])
+          new_beam_state.mean_set[cluster] = (
+              new_beam_state.mean_set[cluster] * (count - 1) +
+              new_mean.clone()) / count  # use mean to predict
+          new_beam_state.hidden_set[cluster] = new_hidden.clone()
+          if cluster != new_beam_state.last_cluster:
+            new_beam_state.block_counts[cluster] += 1
+          new_beam_state.extend_trace(cluster)
+        else:  # new cluster
+          new_beam_state.append(new_mean, new_hidden, cluster)
+        new_beam_state.neg_likelihood = score_set[prev_beam_rank, cluster]
+        updated_beam_set.append(new_beam_state)
+      updated_beam_sets.append(updated_beam_set)
+    return updated_beam_sets
+
+  def predict_online(self, test_sequence, args, beam_set=None):
+    """Continue beam search over newly arrived observations.
+
+    Unlike `predict_single()`, the sequence is not duplicated
+    `args.test_iteration` times: each call extends the beams carried over
+    from the previous call, so a live stream can be clustered chunk by chunk.
+
+    Args:
+      test_sequence: the new observations, a 2-dim numpy array of real
+        numbers, of size `N * D`.
+      args: Inference configurations. See `arguments.py` for details.
+      beam_set: the beam set returned by the previous call, or None to start
+        a new stream.
+
+    Returns:
+      A tuple of:
+
+        - `predicted_cluster_id`: the current best labels for the `N` new
+          observations.
+        - `beam_set`: the beam set to pass to the next call.
+
+    Raises:
+      TypeError: If test_sequence is of wrong type.
+      ValueError: If test_sequence has wrong dimension.
+    """
+    test_sequence_length = self._check_test_sequence(test_sequence)
+    if beam_set is None:
+      beam_set = [BeamState()]
+    if test_sequence_length == 0:
+      return [], beam_set
+
+    self.rnn_model.eval()
+    test_sequence = autograd.Variable(
+        torch.from_numpy(test_sequence).float()).to(self.device)
+    for num_iter in np.arange(0, test_sequence_length, args.look_ahead):
+      look_ahead_seq = test_sequence[num_iter:  num_iter + args.look_ahead, :]
+      beam_set = self._beam_search_step(beam_set, look_ahead_seq, args)
+    predicted_cluster_id = beam_set[0].recent_trace(test_sequence_length)
+    return predicted_cluster_id, beam_set
 
   def predict(self, test_sequences, args):
     """Predict labels for a single or many test sequences using UISRNN model.
@@ -577,6 +867,83 @@ class UISRNN:
     if isinstance(test_sequences, np.ndarray):
       return self.predict_single(test_sequences, args)
     if isinstance(test_sequences, list):
+      return self.predict_batch(test_sequences, args)
+    raise TypeError('test_sequences should be either a list or numpy array.')
+
+  def predict_batch(self, test_sequences, args):
+    """Predict labels for many independent test sequences together.
+
+    Gives the same labels as calling `predict_single()` on each sequence, but
+    advances the beam searches of all sequences in lockstep, so every step
+    scores the beams of all sequences in one tensor operation and runs the
+    GRU once for all of them. Only a look ahead of 1 is batched; otherwise
+    the sequences are decoded one by one.
+
+    If `args.predict_workers` is above 1 and the model is on the CPU, the
+    sequences are further split across a spawned process pool, which
+    receives a pickled copy of the model and the sequences. Workers are
+    spawned, not forked, because the caller may hold TensorFlow state that
+    is not fork-safe.
+
+    Args:
+      test_sequences: a list of test sequences, each a 2-dim numpy array
+        of real numbers. See `predict_single()` for details.
+      args: Inference configurations. See `arguments.py` for details.
+
+    Returns:
+      predicted_cluster_ids: a list of the predicted labels of each sequence.
+
+    Raises:
+      TypeError: If a test sequence is of wrong type.
+      ValueError: If a test sequence has wrong dimension.
+    """
+    test_sequence_lengths = [self._check_test_sequence(test_sequence)
+                             for test_sequence in test_sequences]
+    if args.look_ahead != 1:
       return [self.predict_single(test_sequence, args)
               for test_sequence in test_sequences]
-    raise TypeError('test_sequences should be either a list or numpy array.')
+    num_workers = min(getattr(args, 'predict_workers', 0), len(test_sequences))
+    if num_workers > 1 and self.device.type == 'cpu':
+      return self._predict_pooled(test_sequences, args, num_workers)
+
+    self.rnn_model.eval()
+    test_sequences = [torch.from_numpy(test_sequence).float().to(self.device)
+                      for test_sequence in test_sequences]
+    orders = [self._inference_order(test_sequence_length, args)
+              for test_sequence_length in test_sequence_lengths]
+    beam_sets = [[BeamState()] for _ in test_sequences]
+    num_steps = max([len(order) for order in orders], default=0)
+    with torch.no_grad():
+      for step in tqdm(range(num_steps),
+                       desc = 'Clustering Utterance Features'):
+        active = [seq_idx for seq_idx, order in enumerate(orders)
+                  if step < len(order)]
+        observations = torch.stack(
+            [test_sequences[seq_idx][orders[seq_idx][step]]
+             for seq_idx in active])
+        updated_beam_sets = self._multi_beam_search_step(
+            [beam_sets[seq_idx] for seq_idx in active], observations, args)
+        for seq_idx, beam_set in zip(active, updated_beam_sets):
+          beam_sets[seq_idx] = beam_set
+    return [beam_set[0].recent_trace(test_sequence_length)
+            for beam_set, test_sequence_length in zip(
+                beam_sets, test_sequence_lengths)]
+
+  def _predict_pooled(self, test_sequences, args, num_workers):
+    """Split `predict_batch()` across a spawned pool of `num_workers`."""
+    worker_args = copy.copy(args)
+    worker_args.predict_workers = 0
+    # deal sequences out by length, so every worker gets a similar load and
+    # the sequences batched together have similar lengths
+    by_length = np.argsort([len(test_sequence)
+                            for test_sequence in test_sequences])
+    chunks = [by_length[worker::num_workers] for worker in range(num_workers)]
+    with multiprocessing.get_context('spawn').Pool(
+        num_workers, initializer=_init_predict_worker,
+        initargs=(self, test_sequences, worker_args)) as pool:
+      chunk_labels = pool.map(_predict_chunk, chunks)
+    predicted_cluster_ids = [None] * len(test_sequences)
+    for chunk, labels in zip(chunks, chunk_labels):
+      for seq_idx, predicted_cluster_id in zip(chunk, labels):
+        predicted_cluster_ids[seq_idx] = predicted_cluster_id
+    return predicted_cluster_ids